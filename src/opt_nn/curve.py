@@ -0,0 +1,117 @@
+'''
+Order points along a space-filling curve, so that points close
+together in the order are close together in space.
+
+Points on the unit sphere (from `xyz.cartesian()`) are quantized to
+`BITS` bits on each axis, and each gets one 63-bit key, either by
+interleaving the bits of its coordinates (a Morton, or Z-order, curve)
+or by its position along a Hilbert curve [@Skilling2004], which never
+jumps between distant cells, as the Morton curve does at the edge of
+each octant.
+
+Building and querying a tree in this order means that consecutive
+queries visit the same parts of the tree and of the point array,
+which are then still in cache.
+'''
+
+import numpy as np
+
+
+# bits on each axis, so that a key of all three fits in 64 bits
+BITS = 21
+
+
+def quantize(points, bits=BITS):
+    '''
+    Return (n, 3) uint64 array of points in [-1, 1] scaled to
+    integers in [0, 2**bits).
+    '''
+
+    scale = 2 ** bits
+    cells = np.floor((np.asarray(points, dtype=np.float64) + 1) / 2 * scale)
+
+    return np.clip(cells, 0, scale - 1).astype(np.uint64)
+
+
+def interleave(x, y, z):
+    '''
+    Return keys interleaving bits of (up to 21-bit) uint64 arrays,
+    with x's bit the most significant of each triple.
+    '''
+
+    def spread(v):
+        '''Put two zero bits between each bit of v.'''
+        v = v & np.uint64(0x1fffff)
+        v = (v | v << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+        v = (v | v << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+        v = (v | v << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+        v = (v | v << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+        v = (v | v << np.uint64(2)) & np.uint64(0x1249249249249249)
+        return v
+
+    return ((spread(x) << np.uint64(2)) | (spread(y) << np.uint64(1))
+            | spread(z))
+
+
+def morton_keys(points, bits=BITS):
+    '''Return Morton (Z-order) key of each of (n, 3) array of points.'''
+
+    x, y, z = quantize(points, bits).T
+
+    return interleave(x, y, z)
+
+
+def hilbert_keys(points, bits=BITS):
+    '''
+    Return Hilbert key of each of (n, 3) array of points.
+
+    Coordinates are transformed in place to the "transpose" of their
+    Hilbert index, following Skilling's AxesToTranspose, whose bits
+    then only need interleaving.
+    '''
+
+    X = [axis.copy() for axis in quantize(points, bits).T]
+    n = len(X)
+
+    # undo excess work, from the most significant bit down
+    q = 1 << (bits - 1)
+    while q > 1:
+        p = np.uint64(q - 1)
+        q_bit = np.uint64(q)
+        for i in range(n):
+            high = (X[i] & q_bit) != 0
+            if i == 0:
+                X[0] = np.where(high, X[0] ^ p, X[0])
+            else:
+                t = (X[0] ^ X[i]) & p
+                t = np.where(high, np.uint64(0), t)
+                X[0] = np.where(high, X[0] ^ p, X[0] ^ t)
+                X[i] = X[i] ^ t
+        q >>= 1
+
+    # Gray encode
+    for i in range(1, n):
+        X[i] = X[i] ^ X[i - 1]
+    t = np.zeros_like(X[0])
+    q = 1 << (bits - 1)
+    while q > 1:
+        t = np.where((X[n - 1] & np.uint64(q)) != 0, t ^ np.uint64(q - 1), t)
+        q >>= 1
+    X = [axis ^ t for axis in X]
+
+    return interleave(*X)
+
+
+ORDERS = {'morton': morton_keys, 'hilbert': hilbert_keys}
+
+
+def curve_order(points, curve='morton'):
+    '''
+    Return permutation sorting (n, 3) array of points
+    along given space-filling curve ('morton' or 'hilbert').
+    '''
+
+    if curve not in ORDERS:
+        raise ValueError(f"curve must be one of {', '.join(ORDERS)}")
+
+    return np.argsort(ORDERS[curve](points), kind='stable')
@@ -0,0 +1,126 @@
+'''
+Make or load point dataframes with typed columns, without copying.
+
+`given.make_data()` starts `distance_km` and `neighbour_index` as
+`None`, which makes them object columns (boxing every value as a
+Python object). Dataframes made here instead preallocate them as
+float64 and int64, filled with NaN and -1 until solved, and hold
+`lat` and `lng` as float64 columns which solvers can read as numpy
+arrays without copying (see `lat_lng()`).
+
+Note that `given.slow()` relies on `None` for unsolved points,
+so it still needs a dataframe from `given.make_data()`.
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# output columns, with their dtype and value until solved
+OUTPUTS = {'distance_km': (np.float64, np.nan),
+           'neighbour_index': (np.int64, -1)}
+
+
+def frame(lat, lng):
+    '''
+    Return dataframe of points with given lat and lng arrays
+    (used as they are if already float64), and output columns.
+    '''
+
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    columns = {'lat': lat, 'lng': lng}
+    for name, (dtype, fill) in OUTPUTS.items():
+        columns[name] = np.full(len(lat), fill, dtype=dtype)
+
+    return pd.DataFrame(columns, copy=False)
+
+
+def generate(n=1000, seed=None):
+    '''
+    Generate n random points on the globe, like `given.make_data()`,
+    but from a seeded `numpy.random.Generator`, and with typed columns.
+    '''
+
+    rng = np.random.default_rng(seed)
+    lat = (rng.random(n) - 0.5) * 180
+    lng = (rng.random(n) - 0.5) * 360
+
+    return frame(lat, lng)
+
+
+def clustered(n=1000, clusters=10, spread=1.0, seed=None):
+    '''
+    Generate n random points on the globe, in clusters around
+    random centres, normally distributed with standard deviation
+    `spread` (in degrees of lat and lng).
+    '''
+
+    rng = np.random.default_rng(seed)
+    centre = rng.integers(clusters, size=n)
+    centre_lat = (rng.random(clusters) - 0.5) * 180
+    centre_lng = (rng.random(clusters) - 0.5) * 360
+
+    lat = np.clip(centre_lat[centre] + rng.normal(0, spread, n), -90, 90)
+    lng = centre_lng[centre] + rng.normal(0, spread, n)
+    lng = (lng + 180) % 360 - 180
+
+    return frame(lat, lng)
+
+
+def load(path):
+    '''
+    Load points from CSV, Parquet (which needs `pyarrow`) or NPY file.
+
+    CSV and Parquet files need `lat` and `lng` columns. An NPY file
+    holds either an (n, 2) array of lat and lng, or a structured array
+    with `lat` and `lng` fields, and is memory-mapped rather than read.
+    '''
+
+    path = os.fspath(path)
+
+    if path.endswith('.npy'):
+        points = np.load(path, mmap_mode='r')
+        if points.dtype.names:
+            return frame(points['lat'], points['lng'])
+        if points.ndim != 2 or points.shape[1] != 2:
+            raise ValueError(f'expected (n, 2) array of lat and lng, '
+                             f'not {points.shape}')
+        return frame(points[:, 0], points[:, 1])
+
+    if path.endswith(('.parquet', '.pq')):
+        df = pd.read_parquet(path, columns=['lat', 'lng'])
+    else:
+        df = pd.read_csv(path, usecols=['lat', 'lng'],
+                         dtype={'lat': np.float64, 'lng': np.float64})
+
+    return frame(df.lat.to_numpy(), df.lng.to_numpy())
+
+
+def typed(df):
+    '''
+    Return dataframe (from `given.make_data()`, say) with typed
+    output columns, with NaN and -1 for points not yet solved.
+    '''
+
+    columns = dict()
+    for name, (dtype, fill) in OUTPUTS.items():
+        if name in df.columns:
+            values = pd.to_numeric(df[name]).fillna(fill)
+            columns[name] = values.to_numpy(dtype=dtype)
+        else:
+            columns[name] = np.full(len(df), fill, dtype=dtype)
+
+    return df.assign(**columns)
+
+
+def lat_lng(df):
+    '''
+    Return (lat, lng) of dataframe's points as float64 arrays,
+    which are (read-only) views of its columns if already float64.
+    '''
+
+    return (df['lat'].to_numpy(dtype=np.float64, copy=False),
+            df['lng'].to_numpy(dtype=np.float64, copy=False))
@@ -0,0 +1,204 @@
+'''
+Solve all nearest neighbours at once by searching the 3-d tree
+against itself, rather than once for each point.
+
+Pairs of nodes (a query node and a reference node) are split
+together, level by level, and a pair is dropped as soon as the gap
+between the nodes' bounding boxes is more than the furthest of the
+query node's points could still need to look.
+That bound is the largest k-th nearest distance so far of any point
+in the node, kept for every node and propagated up from the leaves
+each time the leaves' points find nearer neighbours.
+
+Since distance is symmetric, each pair of nodes is only visited once,
+with points compared both ways.
+'''
+
+import numpy as np
+
+from opt_nn.xyz import (KDTree, cartesian, fill_neighbours, merge_rows,
+                        other_than_self)
+
+
+class DualTree():
+    '''
+    3-d tree with bounding boxes and bounds for each node,
+    for finding every point's nearest neighbours at once.
+    '''
+
+    def __init__(self, tree):
+        '''Prepare boxes and levels of (already built) tree.'''
+
+        self.tree = tree
+        self.leaf = tree.left < 0
+        self.count = tree.end - tree.start
+
+        self.levels = tree.levels()
+        self.lo, self.hi = self._boxes()
+
+    def _boxes(self):
+        '''
+        Return (lo, hi) corners of bounding box of each node's points.
+        '''
+
+        tree = self.tree
+
+        return (tree.reduce_nodes(tree.data, np.minimum, self.levels),
+                tree.reduce_nodes(tree.data, np.maximum, self.levels))
+
+    def bounds(self, sq_distances):
+        '''
+        Return largest k-th nearest squared distance so far
+        of any point in each node.
+        '''
+
+        return self.tree.reduce_nodes(sq_distances[:, -1], np.maximum,
+                                      self.levels)
+
+    def gaps(self, a, b):
+        '''Return squared distance between boxes of nodes a and b.'''
+
+        gap = np.maximum(self.lo[b] - self.hi[a], self.lo[a] - self.hi[b])
+
+        return (np.maximum(gap, 0) ** 2).sum(axis=1)
+
+    def query_all(self, k=2, batch_size=4096):
+        '''
+        Return (distances, indices) arrays of shape (n, k) giving
+        k nearest neighbours of every point in tree,
+        including identical point.
+        '''
+
+        tree = self.tree
+        n = tree.n
+
+        sq_distances = np.full((n, k), np.inf)
+        indices = np.full((n, k), -1)
+
+        if n == 0:
+            return np.sqrt(sq_distances), indices
+
+        # every point's own leaf gives it a first k nearest
+        leaves = np.flatnonzero(self.leaf)
+        self._compare(leaves, leaves, sq_distances, indices)
+        bound = self.bounds(sq_distances)
+
+        a = b = np.zeros(1, dtype=np.intp)
+        while len(a):
+            # drop pairs too far apart for either node to need the other
+            # (or only as near as its bound, which could merely tie)
+            gap = self.gaps(a, b)
+            near = (gap < bound[a]) | (gap < bound[b])
+            a, b, gap = a[near], b[near], gap[near]
+
+            # compare points of pairs of (different) leaves,
+            # nearest pairs first, so that bounds shrink soonest
+            base = self.leaf[a] & self.leaf[b] & (a != b)
+            order = np.argsort(gap[base], kind='stable')
+            base_a, base_b = a[base][order], b[base][order]
+            for lo in range(0, len(base_a), batch_size):
+                pair_a = base_a[lo:lo + batch_size]
+                pair_b = base_b[lo:lo + batch_size]
+                gap = self.gaps(pair_a, pair_b)
+                near = (gap < bound[pair_a]) | (gap < bound[pair_b])
+                self._compare(pair_a[near], pair_b[near],
+                              sq_distances, indices)
+                bound = self.bounds(sq_distances)
+
+            a, b = self._split(a[~base], b[~base])
+
+        return np.sqrt(sq_distances), indices
+
+    def _split(self, a, b):
+        '''
+        Return pairs of children of each pair of nodes a <= b
+        (splitting the larger, or both if they are the same size),
+        keeping a <= b and leaving out pairs of a leaf with itself.
+        '''
+
+        tree = self.tree
+        leaf_a, leaf_b = self.leaf[a], self.leaf[b]
+
+        split_a = ~leaf_a & (leaf_b | (self.count[a] >= self.count[b]))
+        split_b = ~leaf_b & (leaf_a | (self.count[b] >= self.count[a]))
+        same = a == b
+
+        pairs = []
+
+        # a node paired with itself gives (left, left), (left, right)
+        # and (right, right)
+        s = same & split_a
+        left, right = tree.left[a[s]], tree.right[a[s]]
+        pairs += [(left, left), (left, right), (right, right)]
+
+        # different nodes: children of a and b are in same order as a and b
+        both = ~same & split_a & split_b
+        for child_a in (tree.left[a[both]], tree.right[a[both]]):
+            for child_b in (tree.left[b[both]], tree.right[b[both]]):
+                pairs.append((child_a, child_b))
+
+        only_a = ~same & split_a & ~split_b
+        for child_a in (tree.left[a[only_a]], tree.right[a[only_a]]):
+            pairs.append((child_a, b[only_a]))
+
+        only_b = ~same & ~split_a & split_b
+        for child_b in (tree.left[b[only_b]], tree.right[b[only_b]]):
+            pairs.append((a[only_b], child_b))
+
+        a, b = (np.concatenate(nodes) for nodes in zip(*pairs))
+
+        # a leaf paired with itself was compared before the search
+        keep = (a != b) | ~self.leaf[a]
+
+        return a[keep], b[keep]
+
+    def _compare(self, a, b, sq_distances, indices):
+        '''
+        Compare all points of each leaf in a with all points of its
+        paired leaf in b, both ways, keeping the k nearest so far.
+        '''
+
+        if len(a) == 0:
+            return
+
+        tree = self.tree
+
+        points_a, padding_a = tree.node_rows(a)
+        points_b, padding_b = tree.node_rows(b)
+
+        distance = ((tree.data[points_a][:, :, None, :]
+                     - tree.data[points_b][:, None, :, :]) ** 2).sum(axis=3)
+        distance[padding_a[:, :, None] | padding_b[:, None, :]] = np.inf
+
+        # nearest of b for each point of a, then nearest of a for each of b
+        # (a leaf paired with itself need only be compared one way)
+        sides = [(points_a, padding_a, distance, points_b)]
+        if (a != b).any():
+            other = a != b
+            sides.append((points_b[other], padding_b[other],
+                          distance[other].transpose(0, 2, 1),
+                          points_a[other]))
+
+        for query, padding, distance, candidate in sides:
+            width = distance.shape[2]
+            query = query[~padding]
+            distance = distance[~padding]
+            candidate = np.broadcast_to(
+                candidate[:, None, :],
+                padding.shape + (width,))[~padding]
+
+            merge_rows(sq_distances, indices, query, distance, candidate)
+
+
+def use_dualtree(df, leafsize=16, from_chord=False):
+    """Use dual-tree search of 3-dimensional k-d tree to give solution"""
+
+    # construct kd-tree from x-y-z coordinates
+    tree = KDTree(cartesian(df), leafsize=leafsize)
+
+    # then search it against itself for all nearest neighbours at once
+    distances, indices = DualTree(tree).query_all(k=2)
+    chord, nearest = other_than_self(distances, indices)
+
+    # then find spherical distance, from chord or by haversine formula
+    return fill_neighbours(df, nearest, chord if from_chord else None)
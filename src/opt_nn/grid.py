@@ -0,0 +1,314 @@
+"""
+Solve nearest-neighbours with a spatial hash rather than a tree.
+
+Points on the unit sphere (from `xyz.cartesian()`) are
+bucketed into a uniform 3-D grid of cubic cells, sized so that each
+occupied cell holds a few points. The points are sorted by cell id,
+so each cell's points are contiguous and can be found by binary
+search over the sorted ids.
+
+Each query searches its home cell, then rings of neighbouring cells
+(all cells at Chebyshev distance r from the home cell), widening until
+the distance to the edge of the searched block of cells is no less than
+the k-th nearest neighbour found so far.
+
+Cells are sized as if points were spread evenly over the sphere, so on
+clustered data (or with many identical points) a cell may hold
+thousands of points. Each such overfull cell is subdivided by a 3-d
+tree of its own points, which queries search instead of comparing
+with every point in the cell.
+
+For the same reason, a point far from all others (say, on the far side
+of the globe from a cluster) would need rings reaching across most of
+the grid. So widening stops after `max_ring` rings, and any query still
+searching is handed to a 3-d tree of all the grid's points instead.
+"""
+
+import numpy as np
+import pandas as pd
+
+from opt_nn.xyz import (KDTree, cartesian, fill_neighbours, gather,
+                        merge_nearest, nearest_in_tree, query_blocks)
+
+
+def ring_offsets(r):
+    '''
+    Return (m, 3) array of cell offsets at Chebyshev distance r.
+
+    Only the six faces of the shell are generated, so this costs
+    O(r^2) rather than O(r^3) for the whole cube of offsets.
+    '''
+
+    if r == 0:
+        return np.zeros((1, 3), dtype=np.int64)
+
+    full = np.arange(-r, r + 1)
+    inner = np.arange(-r + 1, r)
+    faces = []
+
+    # faces normal to each axis, each taking the edges and corners
+    # not already taken by faces normal to earlier axes
+    for axis, (a, b) in enumerate([(full, full), (inner, full),
+                                   (inner, inner)]):
+        u, v = np.meshgrid(a, b, indexing='ij')
+        u, v = u.ravel(), v.ravel()
+        for side in (-r, r):
+            face = np.empty((len(u), 3), dtype=np.int64)
+            face[:, axis] = side
+            face[:, [i for i in range(3) if i != axis]] = np.stack(
+                [u, v], axis=1)
+            faces.append(face)
+
+    return np.concatenate(faces)
+
+
+class Grid:
+    '''
+    Uniform grid of cubic cells over [-1, 1]^3, indexing points
+    near the surface of the unit sphere.
+    '''
+
+    axes = ("x", "y", "z")
+
+    def __init__(self, points, per_cell=2, max_cell=64, max_ring=8):
+        '''
+        Create new grid from (n, 3) array or dataframe of points,
+        with cells sized to hold about `per_cell` points on average,
+        any cell holding more than `max_cell` points subdivided,
+        and queries searching no more than `max_ring` rings of cells.
+        '''
+
+        if isinstance(points, pd.DataFrame):
+            if set(self.axes).issubset(points.columns):
+                points = points[list(self.axes)].to_numpy()
+            else:
+                points = cartesian(points)
+
+        self.data = np.ascontiguousarray(points, dtype=np.float64)
+        self.n = len(self.data)
+        self.max_ring = max_ring
+
+        # area of unit sphere is 4 pi, so this gives per_cell points in
+        # each cell of the sphere's surface, if points are uniform
+        area = 4 * np.pi * per_cell / max(self.n, 1)
+        self.cell_size = min(np.sqrt(area), 2.0)
+        self.cells_per_axis = int(np.ceil(2 / self.cell_size)) + 1
+
+        cells = self.cell_coords(self.data)
+        ids = self.cell_ids(cells)
+
+        # sort points by cell, and record where each cell starts
+        self.index = np.argsort(ids, kind='stable')
+        self.ids, self.start, counts = np.unique(
+            ids[self.index], return_index=True, return_counts=True)
+        self.end = self.start + counts
+
+        # subdivide overfull cells, each with tree of its own points
+        self.overfull = counts > max_cell
+        self.subtrees = {
+            cell: KDTree(self.data[self.index[self.start[cell]:
+                                              self.end[cell]]])
+            for cell in np.flatnonzero(self.overfull).tolist()}
+
+        # tree of all points, built if any query outgrows max_ring
+        self._tree = None
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def nbytes(self):
+        """Memory used by point and cell arrays."""
+
+        return (sum(a.nbytes for a in (self.data, self.index, self.ids,
+                                       self.start, self.end, self.overfull))
+                + sum(tree.nbytes for tree in self.subtrees.values())
+                + (self._tree.nbytes if self._tree is not None else 0))
+
+    @property
+    def tree(self):
+        '''3-d tree of all points, for queries far from any other.'''
+
+        if self._tree is None:
+            self._tree = KDTree(self.data)
+
+        return self._tree
+
+    def cell_coords(self, points):
+        '''Return integer (x, y, z) cell of each point.'''
+
+        cells = np.floor((points + 1) / self.cell_size).astype(np.int64)
+
+        return np.clip(cells, 0, self.cells_per_axis - 1)
+
+    def cell_ids(self, cells):
+        '''Return single integer id of each (x, y, z) cell.'''
+
+        g = self.cells_per_axis
+
+        return (cells[:, 0] * g + cells[:, 1]) * g + cells[:, 2]
+
+    def query_batch(self, points, k=1, batch_size=16384):
+        '''
+        Return (distances, indices) arrays of shape (m, k) giving
+        k nearest neighbours for each of (m, 3) array of points,
+        including identical point.
+        '''
+
+        return query_blocks(self, points, k, batch_size)
+
+    def _query_block(self, points, sq_distances, indices):
+        '''
+        Fill in squared distances and indices of nearest neighbours
+        for one block of query points.
+        '''
+
+        m = len(points)
+        home = self.cell_coords(points)
+        active = np.arange(m)
+
+        r = 0
+        while len(active):
+            if r > self.max_ring:
+                # the few queries still searching are far from
+                # everything else, and quicker to finish with a tree
+                self._search_tree(points, active, sq_distances, indices)
+                break
+
+            self._search_ring(points, active, home[active], r,
+                              sq_distances, indices)
+
+            # distance from each query to edge of searched block of cells
+            lo = (home[active] - r) * self.cell_size - 1
+            hi = (home[active] + r + 1) * self.cell_size - 1
+            q = points[active]
+            edge = np.minimum(q - lo, hi - q).min(axis=1)
+
+            # done once no unsearched cell can hold anything nearer
+            covered = r + 1 >= self.cells_per_axis
+            if covered:
+                break
+            nearer = sq_distances[active, -1] > np.maximum(edge, 0) ** 2
+            active = active[nearer]
+            r += 1
+
+    def _search_ring(self, points, query, home, r, sq_distances, indices,
+                     max_pairs=2**20):
+        '''
+        Compare each query with all points in cells at distance r
+        from its home cell, keeping the k nearest found so far,
+        comparing at most `max_pairs` (query, point) pairs at once.
+        '''
+
+        g = self.cells_per_axis
+        offsets = ring_offsets(r)
+
+        # (query, cell) pairs for occupied cells of ring within grid
+        cells = (home[:, None, :] + offsets[None, :, :]).reshape(-1, 3)
+        pair_query = np.repeat(query, len(offsets))
+        inside = ((cells >= 0) & (cells < g)).all(axis=1)
+        cells, pair_query = cells[inside], pair_query[inside]
+
+        ids = self.cell_ids(cells)
+        found = np.searchsorted(self.ids, ids)
+        found = np.minimum(found, len(self.ids) - 1)
+        occupied = self.ids[found] == ids
+        found, pair_query = found[occupied], pair_query[occupied]
+
+        # overfull cells are searched by their own trees
+        overfull = self.overfull[found]
+        if overfull.any():
+            self._search_subtrees(points, pair_query[overfull],
+                                  found[overfull], sq_distances, indices)
+            found, pair_query = found[~overfull], pair_query[~overfull]
+
+        if len(found) == 0:
+            return
+
+        # compare pairs in chunks of at most max_pairs points (or one
+        # cell, if bigger), splitting a query's cells between chunks
+        # if need be, since merge_nearest() keeps the nearest so far
+        counts = self.end[found] - self.start[found]
+        total = np.cumsum(counts)
+        lo = 0
+        while lo < len(found):
+            hi = np.searchsorted(total, total[lo] - counts[lo] + max_pairs,
+                                 side='right')
+            hi = max(hi, lo + 1)
+            self._compare_cells(points, pair_query[lo:hi], found[lo:hi],
+                                sq_distances, indices)
+            lo = hi
+
+    def _compare_cells(self, points, query, cell, sq_distances, indices):
+        '''
+        Compare each query with all points in its paired cell,
+        keeping the k nearest found so far.
+        '''
+
+        # flatten (query, cell) pairs into (query, point) pairs
+        candidate_query, candidate = gather(query, cell, self.start,
+                                            self.end, self.index)
+
+        distance = ((points[candidate_query] - self.data[candidate]) ** 2)
+        distance = distance.sum(axis=1)
+
+        # no need to pad each query's candidates into a row,
+        # since merge_nearest() can take any number of rows for a query
+        merge_nearest(sq_distances, indices, candidate_query,
+                      distance[:, None], candidate[:, None])
+
+    def _search_tree(self, points, query, sq_distances, indices):
+        '''
+        Replace nearest found so far for each query with
+        the k nearest of all points, found by searching tree.
+        '''
+
+        k = sq_distances.shape[1]
+
+        distance = np.full((len(query), k), np.inf)
+        nearest = np.full((len(query), k), -1)
+        self.tree._query_block(points[query], distance, nearest)
+
+        # tree's search is exhaustive, so its k nearest replace
+        # (rather than merge with) those already found in rings
+        sq_distances[query] = distance
+        indices[query] = nearest
+
+    def _search_subtrees(self, points, query, cell, sq_distances, indices):
+        '''
+        Search each overfull cell's tree for the queries paired with it,
+        keeping the k nearest found so far.
+        '''
+
+        k = sq_distances.shape[1]
+
+        order = np.argsort(cell, kind='stable')
+        query, cell = query[order], cell[order]
+        cells, first = np.unique(cell, return_index=True)
+
+        for c, q in zip(cells.tolist(), np.split(query, first[1:])):
+            tree = self.subtrees[c]
+            distance = np.full((len(q), k), np.inf)
+            local = np.full((len(q), k), -1)
+            tree._query_block(points[q], distance, local)
+
+            # renumber tree's points as points of grid
+            found = local >= 0
+            candidate = np.full((len(q), k), -1)
+            candidate[found] = self.index[self.start[c] + local[found]]
+            merge_nearest(sq_distances, indices, q, distance, candidate)
+
+
+def use_grid(df, per_cell=2, from_chord=False):
+    """Use uniform grid of cells on unit sphere to give solution"""
+
+    points = cartesian(df)
+
+    # construct grid from x-y-z coordinates
+    grid = Grid(points, per_cell=per_cell)
+
+    # then use to find nearest neighbours for all points at once
+    chord, nearest = nearest_in_tree(grid, points, self_join=True)
+
+    # then find spherical distance, from chord or by haversine formula
+    return fill_neighbours(df, nearest, chord if from_chord else None)
@@ -10,6 +10,9 @@ import numpy as np
 from opt_nn.given import haversine, slow, make_data
 
 
+R = 6371  # radius of earth in km, following `given.haversine()`
+
+
 def h_distance(p1, p2):
     '''
     Return haversine distance between two points.
@@ -17,11 +20,87 @@ def h_distance(p1, p2):
     allowing us to more intuitively feed in the 
     two points (with `lng` and `lat` attributes)
     that we are interested in finding the distance for.
+
+    Points may also be blocks of points, whose `lng` and `lat`
+    are arrays, in which case `haversine_array()` is used.)
     '''
 
+    if np.ndim(p1.lng) or np.ndim(p2.lng):
+        return haversine_array(p1.lng, p1.lat, p2.lng, p2.lat)
+
     return haversine(p1.lng, p1.lat, p2.lng, p2.lat)
 
 
+def haversine_array(lng1, lat1, lng2, lat2):
+    '''
+    Return haversine distance (km) between points given in decimal degrees,
+    as `given.haversine()` does, but for arrays of points,
+    which broadcast against each other like any numpy arguments.
+    '''
+
+    lng1, lat1, lng2, lat2 = map(np.radians, (lng1, lat1, lng2, lat2))
+
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+
+    return 2 * R * np.arcsin(np.sqrt(a))
+
+
+def nearest_in_blocks(points, block_size=256):
+    '''
+    Return index of nearest other point for each of (n, 3) array
+    of points on unit sphere, by brute force over all pairs.
+
+    Pairs are compared one square block at a time (so the n x n matrix
+    of distances is never made), with no python loop within a block,
+    whose row-wise argmin of squared chords is each point's nearest
+    within the block (ignoring the diagonal).
+
+    Squared chords are summed from differences of coordinates, not
+    found from a matrix product of dot products (|a|^2 + |b|^2 - 2 a.b),
+    which cancels to rounding error for points a few metres apart.
+    '''
+
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    axes = np.ascontiguousarray(points.T)
+    n = len(points)
+
+    nearest = np.full(n, -1)
+
+    # reuse buffers for each block's squared chords
+    size = min(block_size, n)
+    buffer = np.empty((size, size))
+    square = np.empty((size, size))
+
+    for lo in range(0, n, block_size):
+        hi = min(lo + block_size, n)
+        best = np.full(hi - lo, np.inf)
+
+        for start in range(0, n, block_size):
+            stop = min(start + block_size, n)
+
+            sq_chords = buffer[:hi - lo, :stop - start]
+            sq_chords[...] = 0
+            for axis in axes:
+                out = square[:hi - lo, :stop - start]
+                np.subtract.outer(axis[lo:hi], axis[start:stop], out=out)
+                out *= out
+                sq_chords += out
+            if start == lo:
+                # a point is not its own neighbour
+                np.fill_diagonal(sq_chords, np.inf)
+
+            j = sq_chords.argmin(axis=1)
+            sq_chord = sq_chords[np.arange(hi - lo), j]
+
+            # keep first of equally near points, as `given.slow()` does
+            closer = sq_chord < best
+            best[closer] = sq_chord[closer]
+            nearest[lo:hi][closer] = start + j[closer]
+
+    return nearest
+
+
 def compare_solutions(sol1, sol2=slow, df=None):
     '''
     Compare nearest neighbour indices returned by two solutions.
@@ -46,48 +125,98 @@ def compare_solutions(sol1, sol2=slow, df=None):
 
 class Distances():
     '''
-    Make sure we never calculate a distance twice.
+    Find nearest neighbours by comparing points a block at a time.
+
+    Rather than keeping an n x n table of every distance, only blocks
+    on or above the diagonal are computed (taking advantage of symmetry,
+    so each distance is computed once), and each block's row and column
+    minima are folded into the nearest neighbour found so far for each
+    point. So memory is O(n + block_size^2) rather than O(n^2).
     '''
 
-    def __init__(self, points_df, metric=h_distance):
+    def __init__(self, points_df, metric=h_distance, block_size=256):
         '''
         Initialize with dataframe of points.
+
+        Metric takes two points (or two blocks of points, with array
+        attributes which broadcast against each other) and returns
+        the distance(s) between them.
         '''
 
         self.metric = metric
         self.points = points_df
         self.n = len(points_df)
-        self.table = np.zeros((self.n, self.n), float)
+        self.block_size = block_size
+
+        # nearest neighbour found so far for each point
+        self.distance = np.full(self.n, np.inf)
+        self.nearest = np.full(self.n, -1)
+
+        self.columns = {column: points_df[column].to_numpy()
+                        for column in points_df.select_dtypes('number')}
 
     def lookup(self, i, j):
         '''
         Lookup distance between points i and j,
         as indexed in the points dataframe.
+        (No table is kept, so this is computed afresh on each call.)
         '''
 
-        # take advantage of symmetry
-        if i > j:
-            i, j = j, i
-
         # if points are the same point, no need to look
         if i == j:
             return 0
-        # if we have found the answer before, no need to again
-        elif self.table[i,j]:
-            return self.table[i,j]
-        # otherwise calculate, save, and return
-        else:
-            self.table[i,j] = self.metric(
-                    self.points.iloc[i],
-                    self.points.iloc[j])
-            return self.table[i,j]
+
+        return self.metric(self.points.iloc[i], self.points.iloc[j])
+
+    def block(self, lo, hi, axis):
+        '''
+        Return points lo to hi as a block, with attributes
+        which are arrays along given axis (0 for rows, 1 for columns).
+        '''
+
+        shape = (-1, 1) if axis == 0 else (1, -1)
+
+        return pd.Series({column: values[lo:hi].reshape(shape)
+                          for column, values in self.columns.items()})
 
     def find_all(self):
-        '''Find all distances.'''
+        '''Find all distances, keeping nearest for each point.'''
+
+        size = self.block_size
+
+        for lo in range(0, self.n, size):
+            hi = min(lo + size, self.n)
+            rows = self.block(lo, hi, axis=0)
+
+            for start in range(lo, self.n, size):
+                stop = min(start + size, self.n)
+                columns = self.block(start, stop, axis=1)
 
-        for i in range(self.n):
-            for j in range(i, self.n):
-                self.lookup(i,j)
+                table = self.metric(rows, columns)
+                table = np.broadcast_to(table, (hi - lo, stop - start))
+                # prevent zero distance between same point
+                # looking like minimum
+                table = np.where(table > 0, table, np.inf)
+
+                # nearest in block for each row, then for each column
+                # (points are offered in order of index, so as with
+                # `given.slow()` the first of equally near points wins)
+                self.fold(np.arange(lo, hi), table, start)
+                if start > lo:
+                    self.fold(np.arange(start, stop), table.T, lo)
+
+    def fold(self, points, table, offset):
+        '''
+        Update nearest neighbours of points,
+        given table of their distances to points from offset on.
+        '''
+
+        j = table.argmin(axis=1)
+        distance = table[np.arange(len(points)), j]
+
+        closer = distance < self.distance[points]
+        self.distance[points[closer]] = distance[closer]
+        self.nearest[points[closer]] = offset + j[closer]
 
     def find_nn(self):
         '''
@@ -95,17 +224,13 @@ class Distances():
         and distance.
         '''
 
-        self.find_all()
-        # fill in empty half of matrix
-        self.table = np.maximum(self.table.T, self.table)
-        # prevent zero distance between same point looking like minimum
-        self.table = np.where(self.table > 0, self.table, np.inf)
+        if self.n and (self.nearest < 0).all():
+            self.find_all()
 
-        nn_df = pd.DataFrame([
-            np.min(self.table, axis=0),
-            np.argmin(self.table, axis=0)
-            ]).T
-        nn_df.columns = ['distance_km', 'neighbour_index']
+        # points with no neighbour have distance NaN, not inf
+        distance = np.where(self.nearest >= 0, self.distance, np.nan)
+        nn_df = pd.DataFrame({'distance_km': distance,
+                              'neighbour_index': self.nearest})
 
         return nn_df
 
@@ -157,3 +282,21 @@ def less_slow(df):
 
     return df
 
+
+def use_blocks(df, block_size=256, from_chord=False):
+    '''
+    Compare every pair of points, but in blocks of numpy arrays
+    rather than a python loop. Still O(n^2), but exact and with
+    no index to build, so a good reference for other solutions.
+    '''
+
+    from opt_nn.xyz import cartesian, fill_neighbours
+
+    points = cartesian(df)
+    nearest = nearest_in_blocks(points, block_size)
+
+    chord = None
+    if from_chord:
+        chord = np.sqrt(((points - points[nearest]) ** 2).sum(axis=1))
+
+    return fill_neighbours(df, nearest, chord)
@@ -0,0 +1,286 @@
+'''
+Nearest neighbours for a set of points which changes over time,
+without rebuilding the whole index (or re-solving every point)
+after each change.
+
+The index is a logarithmic forest of static 3-d trees [@Bentley1980]:
+inserted points go into a new small tree, and trees of similar size
+are merged (by rebuilding them as one) so that there are only ever
+O(log n) of them, and each point is rebuilt O(log n) times in total.
+Removed points are tombstoned, and a tree is rebuilt without them
+once too much of it is dead.
+'''
+
+import numpy as np
+import pandas as pd
+
+from opt_nn.given import make_data
+from opt_nn.xyz import KDTree, cartesian, chord_to_km, merge_nearest
+
+
+class IncrementalIndex:
+    '''
+    Forest of 3-d trees supporting `insert()` and `remove()`,
+    and `update_neighbours()` to keep each point's nearest neighbour
+    up to date.
+
+    Points are identified by the id returned when they are inserted,
+    which is never reused.
+    '''
+
+    def __init__(self, points=None, leafsize=16, dead_fraction=0.5):
+        '''
+        Create index, optionally inserting initial points.
+
+        A tree is rebuilt once more than `dead_fraction` of its points
+        have been removed.
+        '''
+
+        self.leafsize = leafsize
+        self.dead_fraction = dead_fraction
+
+        self.data = np.empty((0, 3))
+        self.alive = np.empty(0, dtype=bool)
+        self.n = 0
+
+        # each tree, as (label, global ids of its points, tree),
+        # with label of tree holding each point, and count of dead in each
+        self.trees = []
+        self.tree_of = np.empty(0, dtype=np.intp)
+        self.dead = dict()
+        self._labels = 0
+
+        # nearest neighbour of each point, as found by update_neighbours()
+        self.neighbour_index = np.empty(0, dtype=np.intp)
+        self.distance = np.empty(0)
+
+        # ids whose nearest neighbour must be found again
+        self._changed = set()
+        # ids inserted since neighbours were last updated
+        self._inserted = []
+
+        if points is not None:
+            self.insert(points)
+
+    def __len__(self):
+        '''Number of points currently in index.'''
+
+        return int(self.alive[:self.n].sum())
+
+    def _grow(self, n):
+        '''Make room for n points, doubling capacity as needed.'''
+
+        capacity = len(self.data)
+        if n <= capacity:
+            return
+
+        capacity = max(n, 2 * capacity)
+        for name, fill in (('data', 0.0), ('alive', False),
+                           ('tree_of', -1), ('neighbour_index', -1),
+                           ('distance', np.nan)):
+            old = getattr(self, name)
+            new = np.full((capacity,) + old.shape[1:], fill, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def insert(self, points):
+        '''
+        Insert (m, 3) array or dataframe of points,
+        returning their ids.
+        '''
+
+        if isinstance(points, pd.DataFrame):
+            points = cartesian(points)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+
+        ids = np.arange(self.n, self.n + len(points))
+        self._grow(self.n + len(points))
+        self.data[ids] = points
+        self.alive[ids] = True
+        self.n += len(points)
+
+        self._changed.update(ids.tolist())
+        self._inserted.append(ids)
+
+        if len(ids):
+            self._build(ids)
+            self._merge()
+
+        return ids
+
+    def remove(self, ids):
+        '''Remove points with given ids.'''
+
+        ids = np.unique(np.asarray(ids, dtype=np.intp))
+        ids = ids[self.alive[ids]]
+        self.alive[ids] = False
+        self.neighbour_index[ids] = -1
+        self.distance[ids] = np.nan
+        self._changed.difference_update(ids.tolist())
+
+        # points whose nearest neighbour was removed must find another
+        removed = np.zeros(self.n, dtype=bool)
+        removed[ids] = True
+        neighbours = self.neighbour_index[:self.n]
+        orphans = np.flatnonzero((neighbours >= 0) & removed[neighbours])
+        self._changed.update(orphans.tolist())
+
+        labels, counts = np.unique(self.tree_of[ids], return_counts=True)
+        for label, count in zip(labels.tolist(), counts.tolist()):
+            self.dead[label] += count
+
+        # rebuild any tree with too many dead points
+        rebuild = [(label, tree_ids) for label, tree_ids, _ in self.trees
+                   if self.dead[label] > self.dead_fraction * len(tree_ids)]
+        for label, tree_ids in rebuild:
+            self.trees = [tree for tree in self.trees if tree[0] != label]
+            del self.dead[label]
+            tree_ids = tree_ids[self.alive[tree_ids]]
+            if len(tree_ids):
+                self._build(tree_ids)
+        self._merge()
+
+    def _build(self, ids):
+        '''Add new tree of points with given ids.'''
+
+        label = self._labels
+        self._labels += 1
+
+        tree = KDTree(self.data[ids], leafsize=self.leafsize)
+        self.trees.append((label, ids, tree))
+        self.trees.sort(key=lambda tree: -len(tree[1]))
+        self.tree_of[ids] = label
+        self.dead[label] = 0
+
+    def _merge(self):
+        '''
+        Merge trees until each is less than half the size of the last.
+        '''
+
+        while True:
+            sizes = [len(tree_ids) for _, tree_ids, _ in self.trees]
+            similar = [i for i in range(1, len(sizes))
+                       if 2 * sizes[i] > sizes[i - 1]]
+            if not similar:
+                return
+
+            i = similar[-1]
+            label_a, ids_a, _ = self.trees.pop(i)
+            label_b, ids_b, _ = self.trees.pop(i - 1)
+            del self.dead[label_a], self.dead[label_b]
+            merged = np.concatenate([ids_b, ids_a])
+            self._build(merged[self.alive[merged]])
+
+    def query_batch(self, points, k=1):
+        '''
+        Return (distances, ids) arrays of shape (m, k) giving
+        k nearest points in index to each of (m, 3) array of points,
+        including identical point.
+        '''
+
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        m = len(points)
+
+        distances = np.full((m, k), np.inf)
+        indices = np.full((m, k), -1)
+
+        for label, tree_ids, tree in self.trees:
+            # ask for more neighbours until k of them are alive
+            # (at least half of each tree is alive, so start with 2k)
+            wanted = min(2 * k if self.dead[label] else k, len(tree))
+            pending = np.arange(m)
+            while len(pending):
+                d, local = tree.query_batch(points[pending], wanted)
+                found = tree_ids[local]
+                removed = ~self.alive[found]
+                d[removed] = np.inf
+                found[removed] = -1
+
+                done = ((~removed).sum(axis=1) >= k) | (wanted == len(tree))
+                merge_nearest(distances, indices, pending[done],
+                              d[done], found[done])
+
+                pending = pending[~done]
+                wanted = min(2 * wanted, len(tree))
+
+        return distances, indices
+
+    def update_neighbours(self):
+        '''
+        Find nearest neighbour again for every point whose nearest
+        neighbour could have changed since last update, and return
+        their ids.
+
+        These are the points inserted since, the points whose nearest
+        neighbour was removed, and the points which are closer to an
+        inserted point than to their nearest neighbour so far.
+        '''
+
+        inserted = np.concatenate([np.empty(0, dtype=np.intp)]
+                                  + self._inserted)
+        inserted = inserted[self.alive[inserted]]
+        changed = self._changed
+
+        alive = self.alive[:self.n]
+        solved = self.neighbour_index[:self.n] >= 0
+
+        # points which had no neighbour may have one now
+        if len(inserted):
+            changed.update(np.flatnonzero(alive & ~solved).tolist())
+
+        # look for older points closer to an inserted point than to
+        # their nearest neighbour so far, searching only branches
+        # nearer to the inserted point than some older point's neighbour
+        older = alive & solved
+        older[inserted] = False
+        if len(inserted) and older.any():
+            points = self.data[inserted]
+            for label, tree_ids, tree in self.trees:
+                bound = tree.reduce_nodes(np.where(
+                    older[tree_ids], self.distance[tree_ids], -1.0))
+                sq_bound = np.where(bound >= 0, bound ** 2, -1.0)
+
+                leaves = tree._leaves_near(points,
+                                           lambda q, node: sq_bound[node])
+                for query, node in leaves:
+                    query, local = tree._gather(query, node)
+                    found = tree_ids[local]
+                    d = np.sqrt(((points[query] - tree.coords(local)) ** 2)
+                                .sum(axis=1))
+                    closer = older[found] & (d < self.distance[found])
+                    changed.update(found[closer].tolist())
+
+        ids = np.array(sorted(changed), dtype=np.intp)
+        if len(ids):
+            distances, indices = self.query_batch(self.data[ids], k=2)
+            itself = indices[:, 0] == ids
+            self.neighbour_index[ids] = np.where(itself, indices[:, 1],
+                                                 indices[:, 0])
+            self.distance[ids] = np.where(itself, distances[:, 1],
+                                          distances[:, 0])
+
+        self._changed = set()
+        self._inserted = []
+
+        return ids
+
+    @property
+    def distance_km(self):
+        '''
+        Great-circle distance (km) of each point to nearest neighbour
+        (NaN if it has none).
+        '''
+
+        solved = self.neighbour_index[:self.n] >= 0
+
+        return np.where(solved, chord_to_km(self.distance[:self.n]), np.nan)
+
+
+if __name__ == '__main__':
+
+    index = IncrementalIndex(make_data(10000))
+    print(len(index.update_neighbours()), 'points solved initially')
+
+    index.remove(np.arange(0, 10000, 100))
+    index.insert(make_data(100))
+    print(len(index.update_neighbours()), 'points solved after update')
@@ -7,176 +7,256 @@ time is O(log(n)).
 The main changes are:
     - input takes a dataframe with `lat` and `lng` columns,
         instead of a list of tuples,
-    - 'pivot' point is included in tree, so `closer_distance()`
-        must ignore point if distance is zero
+    - tree is held in flat arrays, built by the same median
+        partitioning as `xyz.KDTree` (which works in any number of
+        dimensions), so that building and searching never touch
+        pandas rows; points are all in the leaves, and the search
+        must ignore the point itself
     - haversine distance used instead of euclidean
-    - need to account for wrapping of the globe at east-west extrema;
-        @CScheidegger2013 suggests three tricks of which the third,
-        'multiple covering' seems simplest.
+    - branches are pruned by a lower bound on the great-circle
+        distance to their lat/lng region (see `min_distance_to_region()`),
+        which also accounts for wrapping of the globe at east-west
+        extrema and at the poles, so there is no need for the
+        'multiple covering' suggested by @CScheidegger2013
     - want to add a visualization of divided plane
 """
 
-from math import asin, sin, cos
+from math import asin, cos, pi, radians, sin
 
-import pandas as pd
+import numpy as np
 
-from opt_nn.improved import h_distance
+from opt_nn.improved import R, haversine_array
+from opt_nn.xyz import KDTree
 
 
-def build_kdtree(points_df, depth=0):
+# region covered by root of tree, as (lat_lo, lat_hi, lng_lo, lng_hi)
+WORLD = (-90, 90, -180, 180)
+
+
+class LatLngTree(KDTree):
     """
-    Build (branch of) kd-tree with points from dataframe.
+    `xyz.KDTree` of (lat, lng) points, rather than x-y-z, which also
+    keeps the region of the globe covered by each node, as an
+    (n_nodes, 4) array of (lat_lo, lat_hi, lng_lo, lng_hi), so that
+    it is saved and loaded (or shared) with the tree's other arrays.
     """
 
-    n = len(points_df)
-    k = 2  # we are working on sphere, and don't need to generalize
+    axes = ("lat", "lng")
 
-    if n == 0:
-        return None
+    arrays = KDTree.arrays + ("region",)
 
-    axis = ("lat", "lng")[depth % k]  # cycle through dimensions
+    def __init__(self, points, leafsize=16, stats=None, workers=None):
+        """
+        Create new tree from (n, 2) array of (lat, lng) points,
+        recording build and search statistics in `stats`,
+        built by `workers` processes (by default, just this one).
 
-    sorted_points = points_df.sort_values(axis)
+        Longitudes are taken into [-180, 180), as `WORLD` assumes,
+        so they may be given in [0, 360) instead.
+        """
 
-    return {
-        "point": sorted_points.iloc[n // 2][["lat", "lng", "point_index"]],
-        "left": build_kdtree(sorted_points[:n // 2], depth + 1),
-        "right": build_kdtree(sorted_points[n // 2 + 1:], depth + 1),
-    }
+        points = np.array(points, dtype=np.float64)
+        points[:, 1] = (points[:, 1] + 180) % 360 - 180
 
+        super().__init__(points, leafsize=leafsize, stats=stats,
+                         workers=workers)
+        self.region = self._regions()
 
-def closer_distance(pivot, p1, p2):
-    if p1 is None:
-        return p2
+    def _regions(self):
+        """
+        Return region covered by each node, found one level at a time:
+        each child takes its parent's region, split on its axis.
+        """
 
-    if p2 is None:
-        return p1
+        region = np.empty((len(self.left), 4))
+        region[:] = WORLD
 
-    d1 = h_distance(pivot, p1)
-    d2 = h_distance(pivot, p2)
+        for nodes in self.levels():
+            left, right = self.left[nodes], self.right[nodes]
+            axis, split = self.axis[nodes], self.split[nodes]
+            region[left] = region[right] = region[nodes]
 
-    # if distance is zero, point is the same
-    # and we must ignore it
-    if d1 == 0:
-        return p2
-    elif d2 == 0:
-        return p1
-    # otherwise return smaller distance
-    elif d1 < d2:
-        return p1
-    else:
-        return p2
+            # lat bounds are columns 0 and 1, lng bounds 2 and 3
+            region[left, 2 * axis + 1] = split
+            region[right, 2 * axis] = split
+
+        return region
 
 
-def min_distance_to_lng_circle(angle, point):
+def build_kdtree(points_df, leafsize=16, stats=None):
+    """
+    Build kd-tree of (lat, lng) of points from dataframe,
+    with the region of the globe covered by each node.
+
+    Once a branch has no more than `leafsize` points it becomes a
+    leaf holding all of them, to be searched in one go by
+    `leaf_closest_point()` rather than by recursing any further.
+    If given an `xyz.TreeStats`, the tree's work is recorded in it.
+    """
+
+    points = np.column_stack([points_df.lat.to_numpy(dtype=np.float64),
+                              points_df.lng.to_numpy(dtype=np.float64)])
+
+    return LatLngTree(points, leafsize=leafsize, stats=stats)
+
+
+def leaf_closest_point(tree, leaf, i):
+    '''
+    Return (distance, index) for closest of all points in leaf
+    to point i, ignoring point itself,
+    with one vectorized haversine calculation.
     '''
-    Return the min. distance between given point and 
-    circle of longitude of given angle.
 
-    For proof of general case see @LStrous2018.
+    bucket = tree.index[tree.start[leaf]:tree.end[leaf]]
+    lat, lng = tree.data[i]
+
+    distances = haversine_array(lng, lat, tree.data[bucket, 1],
+                                tree.data[bucket, 0])
+
+    # the point itself is in the tree, and we must ignore it
+    distances[bucket == i] = np.inf
+
+    j = distances.argmin()
+    return (distances[j], bucket[j])
+
+
+def min_distance_to_lng_circle(angle, lat, lng):
+    '''
+    Return the min. distance between point at (lat, lng) and
+    the half circle of longitude of given angle (in degrees),
+    which runs from pole to pole.
+
+    For proof of general case see @LStrous2018: the nearest point of
+    the full great circle is at distance asin(cos(lat) * sin(dlng)),
+    but it is only on the half circle if |dlng| < 90 degrees;
+    otherwise the nearest point of the half circle is a pole.
     '''
 
-    r = 6371  # radius of earth in km
-    # following `given.haversine()`
+    dlng = radians(lng - angle)
+    lat = radians(lat)
 
-    theta = asin(
-        cos(point.lat) *
-        (cos(angle) * sin(point.lng) - sin(angle) * cos(point.lng)))
+    if cos(dlng) >= 0:
+        theta = asin(min(cos(lat) * abs(sin(dlng)), 1))
+    else:
+        theta = pi / 2 - abs(lat)
 
-    return r * theta
+    return R * theta
 
 
-def min_distance_to_lat_circle(angle, point):
+def min_distance_to_lat_circle(angle, lat):
     '''
-    Return the min. distance between given point
-    and circle of latitude of given angle.
+    Return the min. distance between point at latitude lat
+    and circle of latitude of given angle (in degrees).
 
     Since circles of latitude are not great circles,
     this is easy.
     '''
 
-    r = 6371  # radius of earth in km
-    # following `given.haversine()`
+    theta = abs(radians(angle - lat))
 
-    theta = abs(angle - point.lat)
+    return R * theta
 
-    return r * theta
 
-
-def axis_distance(axis, angle, point):
+def min_distance_to_region(lat, lng, region):
     '''
-    Return appropriate distance for given axis.
+    Return a lower bound on the distance between point at (lat, lng) and
+    any point in region (lat_lo, lat_hi, lng_lo, lng_hi).
+
+    No path from the point can reach the region without crossing
+    its bounding circles of latitude, nor (if the point is outside
+    its range of longitude) without crossing one of its bounding half
+    circles of longitude, so the greater of the two distances is a
+    valid bound. Since this is true geometry on the sphere, it holds
+    across the antimeridian and near the poles, where the region's
+    circles of longitude meet.
     '''
 
-    assert axis in ('lat', 'lng')
+    lat_lo, lat_hi, lng_lo, lng_hi = region
 
-    if axis == 'lat':
-        return min_distance_to_lat_circle(angle, point)
+    if lat < lat_lo:
+        lat_distance = min_distance_to_lat_circle(lat_lo, lat)
+    elif lat > lat_hi:
+        lat_distance = min_distance_to_lat_circle(lat_hi, lat)
     else:
-        return min_distance_to_lng_circle(angle, point)
-
+        lat_distance = 0
 
-def kdtree_closest_point(root, point, depth=0):
-    if root is None:
-        return None
+    if lng_lo <= lng <= lng_hi:
+        lng_distance = 0
+    else:
+        lng_distance = min(min_distance_to_lng_circle(lng_lo, lat, lng),
+                           min_distance_to_lng_circle(lng_hi, lat, lng))
 
-    k = 2  # number of dimensions
-    axis = ("lat", "lng")[depth % k]  # cycle through dimensions
+    return max(lat_distance, lng_distance)
 
-    next_branch = None
-    opposite_branch = None
 
-    if point[axis] < root["point"][axis]:
-        next_branch = root["left"]
-        opposite_branch = root["right"]
-    else:
-        next_branch = root["right"]
-        opposite_branch = root["left"]
-
-    best = closer_distance(point,
-                           kdtree_closest_point(next_branch, point, depth + 1),
-                           root["point"])
+def kdtree_closest_point(tree, i):
+    '''
+    Return (distance, index) of closest point in tree
+    to point i (other than itself).
+    '''
 
-    if h_distance(point, best) > axis_distance(axis, 
-                                                root["point"][axis],
-                                                point):
-        best = closer_distance(
-            point, kdtree_closest_point(opposite_branch, point, depth + 1),
-            best)
+    lat, lng = tree.data[i].tolist()
+    best = (np.inf, -1)
+
+    # branches still to search, nearest first
+    stack = [0] if tree.n else []
+
+    # only count work if recording it
+    stats = tree.stats
+    if stats is not None:
+        visits = distances = pruned = 0
+
+    while stack:
+        node = stack.pop()
+
+        # skip branch if it can't hold anything closer than best so far
+        region = tree.region[node].tolist()
+        if min_distance_to_region(lat, lng, region) >= best[0]:
+            if stats is not None:
+                pruned += 1
+            continue
+        if stats is not None:
+            visits += 1
+
+        if tree.left[node] < 0:
+            if stats is not None:
+                distances += tree.end[node] - tree.start[node]
+            candidate = leaf_closest_point(tree, node, i)
+            if candidate[0] < best[0]:
+                best = candidate
+            continue
+
+        if (lat, lng)[tree.axis[node]] < tree.split[node]:
+            next_branch, opposite = tree.left[node], tree.right[node]
+        else:
+            next_branch, opposite = tree.right[node], tree.left[node]
+
+        # search next_branch first, then opposite if necessary
+        stack.append(opposite)
+        stack.append(next_branch)
+
+    if stats is not None:
+        stats.record_search(visits, distances, pruned)
 
     return best
 
 
-def use_kdtree(points_df):
+def use_kdtree(points_df, leafsize=16, stats=None):
     '''Find nearest neighbours for all points in df using kd-tree'''
 
-    # make `point_index` explicit column
-    points_df['point_index'] = points_df.index
-
-    # # create covering on both sides of the globe
-    # left_cover = points_df.copy()
-    # left_cover['lng'] = points_df['lng'] - 360
-    # right_cover = points_df.copy()
-    # right_cover['lng'] = points_df['lng'] + 360
-    # covered_df = pd.concat([points_df, left_cover, right_cover])
+    # no need to cover both sides of the globe with copies of the points,
+    # since the search bounds account for wrapping at the antimeridian
+    tree = build_kdtree(points_df, leafsize=leafsize, stats=stats)
 
-    # build tree from covered_df
-    # tree = build_kdtree(covered_df)
-
-    # TODO: Debug covering. 
-    # At the moment, adding the left and right covers leads to the
-    # algorithm suggesting that the nearest neighbour for most (but not
-    # all??) points is itself.
+    # find nearest neighbours
+    nearest = [kdtree_closest_point(tree, i) for i in range(tree.n)]
+    distances, indices = zip(*nearest) if nearest else ((), ())
 
-    tree = build_kdtree(points_df)
+    indices = np.array(indices, dtype=np.intp)
+    distances = np.array(distances, dtype=np.float64)
 
-    # find nearest neighbours
-    for i in range(len(points_df)):
-        current_point = points_df.iloc[i]
-        nearest = kdtree_closest_point(tree, current_point)
-        points_df.loc[i, 'neighbour_index'] = nearest.point_index
-        points_df.loc[i, 'distance_km'] = h_distance(current_point,
-                nearest)
+    points_df['neighbour_index'] = indices
+    points_df['distance_km'] = np.where(indices >= 0, distances, np.nan)
 
     return points_df
 
@@ -191,5 +271,5 @@ if __name__ == "__main__":
     from opt_nn.given import make_data
 
     df = make_data(100)
-    a = find_all_nn(df)
+    a = use_kdtree(df)
     print(a)
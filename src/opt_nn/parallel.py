@@ -0,0 +1,196 @@
+'''
+Find nearest neighbours on several cores at once.
+
+The 3-d tree is built in memory shared with worker processes, so that
+they can search it without each having to unpickle (or rebuild) their
+own copy. Each worker answers a slice of the queries and writes its
+answers straight into shared output arrays.
+
+The tree can be built on several cores too: once its top levels are
+split, each subtree below is a separate slice of the index and a
+separate range of node numbers, so workers can build them at once.
+The tree's index and node arrays are made in shared memory from the
+start, so that its subtrees are built in place, with nothing to copy
+back out, and the same arrays are then searched by the query workers.
+'''
+
+import os
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+from opt_nn.improved import haversine_array
+from opt_nn.data import lat_lng
+from opt_nn.xyz import KDTree, cartesian, chord_to_km, other_than_self
+
+
+def shared_empty(shape, dtype):
+    '''
+    Return zeroed array of given shape and dtype in memory
+    which worker processes share, and the spec to pass to them when
+    started, which `view()` turns back into the array.
+
+    Unlike a `SharedMemory` block, which must be closed (and cannot be
+    while any array views it), the memory is freed with the array.
+    '''
+
+    dtype = np.dtype(dtype)
+    shape = np.atleast_1d(shape).tolist()
+    raw = RawArray('b', max(int(np.prod(shape)) * dtype.itemsize, 1))
+    spec = (raw, shape, dtype.str)
+
+    return view(spec), spec
+
+
+def view(spec):
+    '''Return array viewing raw array, given spec from `shared_empty()`.'''
+
+    raw, shape, dtype = spec
+    array = np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape)))
+
+    return array.reshape(shape)
+
+
+# state of each worker process, set up by `_attach_worker()`
+_worker = dict()
+
+
+def _attach_worker(specs, leafsize, from_chord=False):
+    '''Attach worker process to shared tree, inputs and outputs.'''
+
+    arrays = {name: view(spec) for name, spec in specs.items()}
+    tree_arrays = {name: arrays[name] for name in KDTree.arrays}
+
+    _worker['arrays'] = arrays
+    _worker['tree'] = KDTree.from_arrays(leafsize, **tree_arrays)
+    _worker['from_chord'] = from_chord
+
+
+def _solve_slice(bounds):
+    '''Find nearest neighbours for points lo to hi.'''
+
+    lo, hi = bounds
+    tree = _worker['tree']
+    arrays = _worker['arrays']
+    lat, lng = arrays['lat'], arrays['lng']
+
+    distances, indices = tree.query_batch(tree.data[lo:hi], k=2)
+    chord, nearest = other_than_self(distances, indices, offset=lo)
+
+    arrays['neighbour_index'][lo:hi] = nearest
+    if _worker['from_chord']:
+        distance_km = chord_to_km(chord)
+    else:
+        distance_km = haversine_array(lng[lo:hi], lat[lo:hi],
+                                      lng[nearest], lat[nearest])
+    arrays['distance_km'][lo:hi] = np.where(nearest >= 0, distance_km,
+                                            np.nan)
+
+
+def _attach_builder(specs, leafsize):
+    '''Attach worker process to tree being built in shared arrays.'''
+
+    arrays = {name: view(spec) for name, spec in specs.items()}
+    _worker['tree'] = KDTree.from_arrays(leafsize, **arrays)
+
+
+def _build_subtree(root):
+    '''Build subtree of shared tree, given its (start, end, depth, node).'''
+
+    _worker['tree']._split(*root)
+
+
+def build_subtrees(tree, workers=None):
+    '''
+    Build tree (whose points are set) with `workers` processes
+    (by default, one for each core), splitting its top few levels
+    here, and building the subtrees below them in the pool,
+    returning specs of its arrays (see `shared_empty()`).
+
+    The tree's points, index and node arrays are made in shared memory,
+    for the workers to build subtrees in place (and for other workers
+    to search it afterwards). Since each subtree is built just as
+    `KDTree._split()` would build it in this process, the tree is
+    exactly the same as if built here.
+    '''
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    specs = dict()
+
+    def empty(name, size, dtype):
+        array, specs[name] = shared_empty(size, dtype)
+        return array
+
+    tree._allocate(empty)
+
+    # workers only need to read points, so tree keeps shared copy
+    data = empty('data', tree.data.shape, tree.data.dtype)
+    data[...] = tree.data
+    tree.data = data
+
+    if tree.n == 0:
+        return specs
+
+    if workers <= 1:
+        tree._split(0, tree.n, 0, 0)
+        return specs
+
+    # a few subtrees for each worker, to balance load
+    levels = int(np.ceil(np.log2(4 * workers)))
+    roots = tree._split(0, tree.n, 0, 0, levels)
+    if not roots:
+        return specs
+
+    # build largest subtrees first, to balance load
+    roots = sorted(roots, key=lambda root: root[0] - root[1])
+    with Pool(workers, initializer=_attach_builder,
+              initargs=(specs, tree.leafsize)) as pool:
+        pool.map(_build_subtree, roots, chunksize=1)
+
+    return specs
+
+
+def nearest_neighbours(df, workers=None, leafsize=16, chunks_per_worker=4,
+                       from_chord=False):
+    '''
+    Find nearest neighbours for all points in df,
+    using 3-d tree searched by `workers` processes
+    (by default, one for each core).
+
+    Gives exactly the same answers as `xyz.use_3dtree()`
+    (with the same `from_chord`).
+    '''
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    n = len(df)
+
+    # tree is built in shared memory, so workers search it as it is
+    tree = KDTree(cartesian(df), leafsize=leafsize, workers=workers)
+    specs = dict(tree.shared)
+
+    arrays = dict()
+    for name, values in zip(('lat', 'lng'), lat_lng(df)):
+        arrays[name], specs[name] = shared_empty(n, np.float64)
+        arrays[name][...] = values
+    for name, fill in (('neighbour_index', -1), ('distance_km', np.nan)):
+        arrays[name], specs[name] = shared_empty(n, type(fill))
+        arrays[name][...] = fill
+
+    # split queries into a few slices per worker, to balance load
+    size = max(-(-n // (workers * chunks_per_worker)), 1)
+    slices = [(lo, min(lo + size, n)) for lo in range(0, n, size)]
+
+    with Pool(workers, initializer=_attach_worker,
+              initargs=(specs, leafsize, from_chord)) as pool:
+        pool.map(_solve_slice, slices)
+
+    # shared memory is freed with the arrays, so no need to copy out
+    df['neighbour_index'] = arrays['neighbour_index']
+    df['distance_km'] = arrays['distance_km']
+
+    return df
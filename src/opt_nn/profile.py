@@ -2,24 +2,453 @@
 Analyze solutions with insightful graphs.
 '''
 
-import time
+import json
 import os
+import platform
+import time
+import tracemalloc
+from datetime import datetime, timezone
 
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from opt_nn import data, dualtree, grid, kdtree, xyz
 from opt_nn.given import make_data
 
 
-def time_solution(solution, n):
-    '''Time solution for dataset of given length.'''
+# dataset sizes to sweep, up to where only the fastest engines can go
+SIZES = (10, 100, 1000, 10**4, 10**5, 10**6, 10**7)
+
+# solutions which can be timed in separate build and query phases:
+# `build` takes the dataframe and returns an index, `query` takes the
+# index and a copy of the dataframe, and fills in nearest neighbours
+# (other than itself) for all of its points, with haversine distances,
+# so that every query phase does the same work from search to output
+PHASES = {
+    # trees are built as reference indexes, so that their memory
+    # includes the lat/lng they re-rank (or find distances) with
+    'use_3dtree': {
+        'build': lambda df: xyz.ReferenceIndex(df),
+        'query': lambda index, df: index.query(df, self_join=True),
+    },
+    # compact trees query a few more candidates, to be re-ranked
+    'use_3dtree float32': {
+        'build': lambda df: xyz.ReferenceIndex(df, compact='float32'),
+        'query': lambda index, df: index.query(df, self_join=True),
+    },
+    'use_3dtree int32': {
+        'build': lambda df: xyz.ReferenceIndex(df, compact='int32'),
+        'query': lambda index, df: index.query(df, self_join=True),
+    },
+    'use_grid': {
+        'build': lambda df: grid.Grid(df),
+        'query': lambda index, df: fill_self_join(
+            df, *index.query_batch(index.data, k=2)),
+    },
+    'use_dualtree': {
+        'build': lambda df: dualtree.DualTree(xyz.KDTree(df)),
+        'query': lambda index, df: fill_self_join(df, *index.query_all(k=2)),
+    },
+}
+
+
+def fill_self_join(df, distances, indices):
+    '''
+    Fill in each point's nearest neighbour other than itself in df,
+    given (n, 2) distances and indices of its two nearest, with
+    distance by haversine (as `xyz.ReferenceIndex.query()` gives it).
+    '''
+
+    chord, nearest = xyz.other_than_self(distances, indices)
+
+    return xyz.fill_neighbours(df, nearest)
+
+
+# solutions whose trees can record `xyz.TreeStats`
+TREES = {
+    'xyz': lambda df, stats: xyz.use_3dtree(df, stats=stats),
+    'kdtree': lambda df, stats: kdtree.use_kdtree(df, stats=stats),
+}
+
+# kinds of dataset, to tell pathologies of the data from plain cost of n
+DATASETS = {
+    'uniform': lambda n, seed: data.generate(n, seed),
+    'clustered': lambda n, seed: data.clustered(n, seed=seed),
+}
+
+
+def seeded_data(n, seed=0):
+    '''Make dataset of given length, the same every time for a seed.'''
+
+    np.random.seed(seed)
+    return make_data(n)
+
+
+def measure(run, setup, repeats=5, budget=None):
+    '''
+    Return list of times taken by `run(setup())`, timing only `run`,
+    repeated unless any one run takes longer than budget (s).
+    '''
+
+    times = []
+    for _ in range(repeats):
+        arg = setup()
+        t0 = time.perf_counter()  # start timer
+        run(arg)
+        times.append(time.perf_counter() - t0)  # stop timer
+
+        if budget is not None and times[-1] > budget:
+            break
+
+    return times
+
 
-    df = make_data(n)  # create dataframe of length n
-    t0 = time.time()  # start timer
-    solution(df)  # solve
-    t1 = time.time()  # stop timer
+def peak_memory(run, setup):
+    '''Return peak memory (MB) allocated by `run(setup())`.'''
+
+    arg = setup()
+    tracemalloc.start()
+    try:
+        run(arg)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak / 2**20
+
+
+def summarize(times):
+    '''Return median and interquartile range of times.'''
+
+    q1, median, q3 = np.percentile(times, [25, 50, 75])
+
+    return {'median': float(median), 'iqr': float(q3 - q1),
+            'repeats': len(times)}
+
+
+def time_solution(solution, n, repeats=5, seed=0, budget=None,
+                  memory=False):
+    '''
+    Time solution for (seeded) dataset of given length,
+    returning summary of times (and optionally peak memory)
+    for each phase of the solution.
+
+    Solution is either a function solving a dataframe (timed as a
+    single 'solve' phase), or a dict of 'build' and 'query' phases
+    like those in `PHASES`. Making the data is never timed.
+    For the build phase, the index's memory (if it has `nbytes`)
+    is also given in bytes per point.
+    '''
+
+    df = seeded_data(n, seed)
+
+    if callable(solution):
+        phases = {'solve': (solution, lambda: df.copy())}
+    else:
+        index = solution['build'](df.copy())
+        phases = {'build': (solution['build'], lambda: df.copy()),
+                  'query': (lambda args: solution['query'](*args),
+                            lambda: (index, df.copy()))}
+
+    results = dict()
+    for phase, (run, setup) in phases.items():
+        results[phase] = summarize(measure(run, setup, repeats, budget))
+        if memory:
+            results[phase]['peak_mb'] = peak_memory(run, setup)
+
+    if not callable(solution) and hasattr(index, 'nbytes'):
+        results['build']['bytes_per_point'] = index.nbytes / max(n, 1)
+
+    return results
+
+
+def benchmark(solutions, sizes=SIZES, repeats=5, budget=60.0, seed=0,
+              memory=True):
+    '''
+    Benchmark solutions (dict of name to solution, as taken by
+    `time_solution()`) on datasets of increasing size, returning
+    a list of records, one for each solution, size and phase.
+
+    Each solution is warmed up on a small dataset first, and is
+    skipped for larger sizes once its median time, scaled up (at least)
+    linearly with n, would go over budget (s).
+    '''
+
+    records = []
+
+    for name, solution in solutions.items():
+        time_solution(solution, 10, repeats=1, seed=seed)  # warm up
+
+        for n, next_n in zip(sizes, list(sizes[1:]) + [None]):
+            results = time_solution(solution, n, repeats, seed, budget,
+                                    memory)
+            for phase, summary in results.items():
+                records.append({'solution': name, 'n': n, 'phase': phase,
+                                **summary})
+
+            t = sum(summary['median'] for summary in results.values())
+            if next_n is not None and t * next_n / n > budget:
+                break
+
+    return records
+
+
+def package_version():
+    '''Return installed version of this package, if known.'''
+
+    try:
+        from importlib.metadata import version
+        return version('optimize-nn')
+    except Exception:
+        return 'unknown'
+
+
+def save_benchmark(records, directory='tables', name='benchmark'):
+    '''
+    Save benchmark records as JSON (with details of the versions and
+    machine used) and CSV in directory, returning the two paths.
+    '''
+
+    if not os.path.exists(directory):
+        os.mkdir(directory)
+
+    json_path = os.path.join(directory, f'{name}.json')
+    csv_path = os.path.join(directory, f'{name}.csv')
+
+    with open(json_path, 'w') as f:
+        json.dump({
+            'version': package_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'records': records,
+        }, f, indent=1)
+
+    pd.DataFrame(records).to_csv(csv_path, index=False, float_format='%.6g')
+
+    return json_path, csv_path
+
+
+def compare_benchmarks(before, after, threshold=1.2):
+    '''
+    Compare two saved benchmark JSON files, returning dataframe of
+    (solution, n, phase) medians which got slower by more than
+    threshold, beyond the noise given by their interquartile ranges.
+    '''
+
+    def load(path):
+        with open(path) as f:
+            records = json.load(f)['records']
+        return pd.DataFrame(records).set_index(['solution', 'n', 'phase'])
+
+    df = load(before).join(load(after), lsuffix='_before',
+                           rsuffix='_after', how='inner')
+    df['ratio'] = df.median_after / df.median_before
+
+    slower = ((df.ratio > threshold)
+              & (df.median_after - df.iqr_after
+                 > df.median_before + df.iqr_before))
+
+    return df[slower][['median_before', 'median_after', 'ratio']]
+
+
+def plot_benchmark(records, figsize=(10, 10)):
+    '''
+    Log-log graph of dataset-size vs median time taken by
+    each solution and phase, with interquartile ranges.
+    '''
+
+    df = pd.DataFrame(records)
+
+    fig, ax = plt.subplots(figsize=figsize)
+
+    for (solution, phase), group in df.groupby(['solution', 'phase']):
+        label = solution if phase == 'solve' else f'{solution} ({phase})'
+        ax.errorbar(group.n, group['median'], yerr=group.iqr / 2,
+                    label=label, marker='o', capsize=3)
+
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    ax.set_xlabel('n')
+    ax.set_ylabel('median t (s)')
+    ax.set_title('Time taken (t) by solutions on datasets of varying size (n)')
+    plt.legend()
+
+    if not os.path.exists('figs'):
+        os.mkdir('figs')
+    plt.savefig(os.path.join('figs', 'benchmark.png'))
+    plt.show()
+
+
+def tree_stats(trees=(('xyz', SIZES[:6]), ('kdtree', SIZES[:4])),
+               datasets=DATASETS, seed=0):
+    '''
+    Record `xyz.TreeStats` of each tree in `TREES` solving each kind
+    of dataset at the given sizes, returning list of records
+    of the summary for each tree, dataset and size.
+    '''
 
-    return t1 - t0  # return time taken
+    records = []
+
+    for tree, sizes in trees:
+        for dataset, make in datasets.items():
+            for n in sizes:
+                stats = xyz.TreeStats()
+                TREES[tree](make(n, seed), stats)
+                records.append({'tree': tree, 'data': dataset, 'n': n,
+                                **stats.summary()})
+
+    return records
+
+
+def plot_tree_stats(records, figsize=(15, 10)):
+    '''
+    Graphs of dataset-size vs work done per query, pruning,
+    depth and build time, for each tree and kind of dataset.
+    '''
+
+    df = pd.DataFrame(records)
+
+    fig, axes = plt.subplots(2, 3, figsize=figsize)
+    panels = [('visits_mean', 'nodes visited per query'),
+              ('distances_per_query', 'distances per query'),
+              ('prune_rate', 'fraction of branches pruned'),
+              ('depth_max', 'depth of deepest leaf'),
+              ('depth_min', 'depth of shallowest leaf'),
+              ('build_s', 'build time (s)')]
+
+    for ax, (column, title) in zip(axes.flat, panels):
+        for (tree, dataset), group in df.groupby(['tree', 'data']):
+            ax.plot(group.n, group[column], label=f'{tree} ({dataset})',
+                    marker='o',
+                    linestyle='--' if dataset != 'uniform' else '-')
+        ax.set_xscale('log')
+        if column == 'build_s':
+            ax.set_yscale('log')
+        ax.set_xlabel('n')
+        ax.set_title(title)
+
+    axes.flat[0].legend()
+    fig.suptitle('Work done by trees on datasets of varying size (n)')
+
+    if not os.path.exists('figs'):
+        os.mkdir('figs')
+    plt.savefig(os.path.join('figs', 'tree_stats.png'))
+    plt.show()
+
+
+def accuracy_curve(n=10**5, eps=(0, 0.001, 0.01, 0.1, 0.5, 1, 2, 4),
+                   max_leaves=(0, 1, 2, 4, 8, 16), repeats=3, seed=0):
+    '''
+    Time `xyz.use_approximate()` with each setting of eps (searching
+    all leaves) and of max_leaves (with eps of 0) on (seeded) dataset
+    of given length, returning list of records of median time and
+    `xyz.approximation_error()` against exact `xyz.use_3dtree()`.
+    '''
+
+    df = data.generate(n, seed)
+    exact = xyz.use_3dtree(df.copy())
+
+    settings = ([{'eps': e, 'max_leaves': None} for e in eps]
+                + [{'eps': 0, 'max_leaves': m} for m in max_leaves])
+
+    records = []
+    for setting in settings:
+        def solve(df):
+            return xyz.use_approximate(df, **setting)
+        times = measure(solve, lambda: df.copy(), repeats)
+        error = xyz.approximation_error(solve(df.copy()), exact)
+        records.append({'n': n, **setting, **summarize(times), **error})
+
+    return records
+
+
+def plot_accuracy(records, figsize=(10, 10)):
+    '''
+    Graph of time taken vs accuracy of approximate solutions,
+    for each way of approximating, with the tolerance of TASK.md.
+    '''
+
+    df = pd.DataFrame(records)
+
+    fig, ax = plt.subplots(figsize=figsize)
+
+    for label, group in (('eps', df[df.max_leaves.isna()]),
+                         ('max_leaves', df[df.max_leaves.notna()])):
+        ax.plot(group['median'], 1 - group.within_tolerance,
+                label=f'varying {label}', marker='o')
+        for _, row in group.iterrows():
+            ax.annotate(f'{row[label]:g}', (row['median'],
+                                            1 - row.within_tolerance))
+
+    ax.set_yscale('symlog', linthresh=1e-5)
+    ax.set_xlabel('median t (s)')
+    ax.set_ylabel(f'fraction of distances more than '
+                  f'{xyz.TOLERANCE:.1%} too far')
+    ax.set_title(f'Speed vs accuracy of approximate solutions '
+                 f'(n={df.n.iloc[0]})')
+    plt.legend()
+
+    if not os.path.exists('figs'):
+        os.mkdir('figs')
+    plt.savefig(os.path.join('figs', 'accuracy.png'))
+    plt.show()
+
+
+def build_scaling(sizes=(10**5, 10**6, 10**7), workers=(1, 2, 4, 8, 16, 32),
+                  repeats=3, seed=0):
+    '''
+    Time building `xyz.KDTree` of (seeded) datasets of given sizes
+    with each number of workers, returning list of records of
+    summary of times for each size and number of workers.
+    '''
+
+    records = []
+
+    for n in sizes:
+        points = xyz.cartesian(data.generate(n, seed))
+        for w in workers:
+            times = measure(lambda points: xyz.KDTree(points, workers=w),
+                            lambda: points, repeats)
+            records.append({'n': n, 'workers': w, **summarize(times)})
+
+    return records
+
+
+def plot_build_scaling(records, figsize=(10, 10)):
+    '''
+    Log-log graph of number of workers vs speed-up of building tree
+    (relative to one worker) for each dataset size, with ideal scaling.
+    '''
+
+    df = pd.DataFrame(records)
+
+    fig, ax = plt.subplots(figsize=figsize)
+
+    for n, group in df.groupby('n'):
+        serial = group[group.workers == 1]['median'].iloc[0]
+        ax.plot(group.workers, serial / group['median'], label=f'n={n}',
+                marker='o')
+
+    workers = sorted(df.workers.unique())
+    ax.plot(workers, workers, label='ideal', linestyle='--', color='grey')
+    ax.axvline(os.cpu_count(), label='cores', linestyle=':', color='grey')
+
+    ax.set_xscale('log', base=2)
+    ax.set_yscale('log', base=2)
+    ax.set_xlabel('workers')
+    ax.set_ylabel('speed-up of build')
+    ax.set_title('Scaling of parallel tree build with number of workers')
+    plt.legend()
+
+    if not os.path.exists('figs'):
+        os.mkdir('figs')
+    plt.savefig(os.path.join('figs', 'build_scaling.png'))
+    plt.show()
 
 
 def compare_solutions(solution_list, dataset_sizes=range(10, 1001, 100)):
@@ -33,11 +462,84 @@ def compare_solutions(solution_list, dataset_sizes=range(10, 1001, 100)):
 
         results[solution_name] = dict()
         for n in dataset_sizes:
-            results[solution_name][n] = time_solution(solution, n)
+            times = time_solution(solution, n, repeats=1)
+            results[solution_name][n] = times['solve']['median']
 
     return results
 
 
+def time_leafsize(tree, n, leafsize):
+    '''
+    Time building and querying tree (`xyz` or `kdtree`)
+    with given leafsize on dataset of given length.
+    '''
+
+    df = make_data(n)
+
+    if tree == 'xyz':
+        points = xyz.cartesian(df)
+        t0 = time.perf_counter()
+        index = xyz.KDTree(points, leafsize=leafsize)
+        t1 = time.perf_counter()
+        index.query_batch(points, k=2)
+        t2 = time.perf_counter()
+    else:
+        t0 = time.perf_counter()
+        index = kdtree.build_kdtree(df, leafsize=leafsize)
+        t1 = time.perf_counter()
+        for i in range(n):
+            kdtree.kdtree_closest_point(index, i)
+        t2 = time.perf_counter()
+
+    return {'build': t1 - t0, 'query': t2 - t1}
+
+
+def compare_leafsizes(trees=(('xyz', 100000), ('kdtree', 1000)),
+                      leafsizes=(1, 2, 4, 8, 16, 32, 64, 128)):
+    '''
+    Compare build and query times of trees with different leafsizes,
+    each on a dataset of the given length.
+    '''
+
+    results = dict()
+
+    for tree, n in trees:
+        for phase in ('build', 'query'):
+            results[f'{tree} {phase} (n={n})'] = dict()
+        for leafsize in leafsizes:
+            times = time_leafsize(tree, n, leafsize)
+            for phase, t in times.items():
+                results[f'{tree} {phase} (n={n})'][leafsize] = t
+
+    return results
+
+
+def plot_leafsizes(results, figsize=(10, 10)):
+    '''
+    Line graph plotting leafsize vs time taken for each tree and phase.
+    '''
+
+    fig, ax = plt.subplots(figsize=figsize)
+
+    for label in results.keys():
+        ax.plot(results[label].keys(),
+                results[label].values(),
+                label=label, marker='o')
+
+    ax.set_xscale('log', base=2)
+    ax.set_yscale('log')
+    ax.set_xlabel('leafsize')
+    ax.set_ylabel('t')
+    ax.set_title('Time taken (t) to build and query trees '
+                 'with varying leafsize')
+    plt.legend()
+
+    if not os.path.exists('figs'):
+        os.mkdir('figs')
+    plt.savefig(os.path.join('figs', 'leafsizes.png'))
+    plt.show()
+
+
 def plot_comparison(results, figsize=(10, 10)):
     '''
     Line graph plotting dataset-size vs time-taken for each solution.
@@ -64,18 +566,47 @@ def plot_comparison(results, figsize=(10, 10)):
 if __name__=='__main__':
 
     from opt_nn.given import slow
-    from opt_nn.improved import less_slow
+    from opt_nn.improved import less_slow, use_blocks
     from opt_nn.kdtree import use_kdtree
     from opt_nn.xyz import use_3dtree
+    from opt_nn.grid import use_grid
+    from opt_nn.dualtree import use_dualtree
+
+    solutions = {'slow': slow, 'less_slow': less_slow,
+                 'use_blocks': use_blocks, 'use_kdtree': use_kdtree,
+                 'use_3dtree': use_3dtree,
+                 'use_grid': use_grid, 'use_dualtree': use_dualtree,
+                 'use_3dtree morton':
+                     lambda df: use_3dtree(df, order='morton')}
+    # also time build and query phases of the fastest engines
+    solutions.update({f'{name} phases': phases
+                      for name, phases in PHASES.items()})
+
+    records = benchmark(solutions)
+    save_benchmark(records)
 
-    solutions = [slow, less_slow, use_kdtree, use_3dtree]
+    # summary table of median total time for each solution
+    results = pd.DataFrame(records).groupby(['n', 'solution'])['median']
+    results = results.sum().unstack()
+    results.to_csv('tables/results.csv', float_format='%.4f')
+    plot_benchmark(records)
 
-    results = compare_solutions(solutions)
+    scaling_records = build_scaling()
+    pd.DataFrame(scaling_records).to_csv('tables/build_scaling.csv',
+            index=False, float_format='%.6g')
+    plot_build_scaling(scaling_records)
 
-    if not os.path.exists('tables'):
-        os.mkdir('tables')
-    pd.DataFrame(results).to_csv('tables/results.csv', 
-            float_format='%.2f')
-    plot_comparison(results)
+    accuracy_records = accuracy_curve()
+    pd.DataFrame(accuracy_records).to_csv('tables/accuracy.csv',
+            index=False, float_format='%.6g')
+    plot_accuracy(accuracy_records)
 
+    stats_records = tree_stats()
+    pd.DataFrame(stats_records).to_csv('tables/tree_stats.csv',
+            index=False, float_format='%.4f')
+    plot_tree_stats(stats_records)
 
+    leafsize_results = compare_leafsizes()
+    pd.DataFrame(leafsize_results).to_csv('tables/leafsizes.csv',
+            float_format='%.4f')
+    plot_leafsizes(leafsize_results)
@@ -0,0 +1,366 @@
+'''
+Serve nearest-neighbour queries from one loaded index to many callers.
+
+Callers each ask for the nearest reference point to a single point,
+but answering them one at a time would pay Python's overhead for every
+query. Instead, the server collects the queries arriving within a short
+window into one batch, answers the whole batch with one vectorized
+query of the index (in a thread pool, since numpy releases the GIL
+for most of the work), and then hands each caller its own answer.
+
+The protocol is newline-delimited JSON over TCP or a Unix socket:
+each request is `{"lat": ..., "lng": ...}` and each response is
+`{"neighbour_index": ..., "distance_km": ...}`, in the same order as
+the requests on that connection. A request of `{"stats": true}` gets
+the server's latency and batch-size counters instead. A point with no
+neighbour (if the index has no points) gets `"neighbour_index": -1`
+and `"distance_km": null`, and a request which can't be understood,
+or can't be answered (say, once the service has stopped), gets
+`{"error": ...}`.
+'''
+
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from opt_nn.xyz import ReferenceIndex
+
+
+class QueryService():
+    '''
+    Batch single-point queries of a `xyz.ReferenceIndex`,
+    keeping counters of latency and batch size.
+    '''
+
+    def __init__(self, index, window=0.002, max_batch=4096, workers=2,
+                 history=10000):
+        '''
+        Serve queries of index, batching those which arrive within
+        `window` seconds (up to `max_batch` at once), answered by up
+        to `workers` threads, with latency kept for the last `history`
+        queries.
+        '''
+
+        self.index = index
+        self.window = window
+        self.max_batch = max_batch
+        self.workers = workers
+
+        self.latencies = deque(maxlen=history)
+        self.queries = 0
+        self.batches = 0
+        self.largest_batch = 0
+
+        self._pending = None
+        self._pool = None
+        self._batcher = None
+        self._running = None
+        self._answering = set()
+
+    async def start(self):
+        '''Start collecting and answering batches of queries.'''
+
+        self._pending = asyncio.Queue()
+        self._pool = ThreadPoolExecutor(self.workers)
+        self._running = asyncio.Semaphore(self.workers)
+        self._batcher = asyncio.create_task(self._collect())
+
+    async def stop(self):
+        '''
+        Stop answering queries, once batches already being answered
+        are done, failing any queries not yet in one.
+        '''
+
+        if self._batcher is None:
+            return
+
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        self._batcher = None
+
+        # callers still waiting to join a batch would wait forever
+        stopped = RuntimeError('query service stopped')
+        while not self._pending.empty():
+            self._fail([self._pending.get_nowait()], stopped)
+
+        # threads are then idle, so the loop need not wait for them
+        await asyncio.gather(*self._answering)
+        self._pool.shutdown(wait=False)
+
+    async def lookup(self, lat, lng):
+        '''
+        Return (neighbour_index, distance_km) of nearest reference point
+        to point at (lat, lng), answered as part of the next batch.
+        '''
+
+        if self._batcher is None:
+            raise RuntimeError('query service not running')
+
+        future = asyncio.get_running_loop().create_future()
+        await self._pending.put((float(lat), float(lng), future,
+                                 time.perf_counter()))
+
+        return await future
+
+    async def _collect(self):
+        '''Gather queries into batches, and start answering each.'''
+
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._pending.get()]
+            deadline = loop.time() + self.window
+
+            try:
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(
+                            self._pending.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                # don't start more batches than there are threads to answer
+                await self._running.acquire()
+            except asyncio.CancelledError:
+                self._fail(batch, RuntimeError('query service stopped'))
+                raise
+
+            task = asyncio.create_task(self._answer(batch))
+            self._answering.add(task)
+            task.add_done_callback(self._answering.discard)
+
+    async def _answer(self, batch):
+        '''Answer batch of queries in thread pool.'''
+
+        try:
+            lat, lng, futures, started = zip(*batch)
+            df = pd.DataFrame({'lat': lat, 'lng': lng})
+
+            loop = asyncio.get_running_loop()
+            try:
+                df = await loop.run_in_executor(self._pool,
+                                                self.index.query, df)
+            except Exception as e:
+                self._fail(batch, e)
+                return
+
+            finished = time.perf_counter()
+            self.latencies.extend(finished - t for t in started)
+            self.queries += len(batch)
+            self.batches += 1
+            self.largest_batch = max(self.largest_batch, len(batch))
+
+            answers = zip(df.neighbour_index.tolist(),
+                          df.distance_km.tolist())
+            for future, answer in zip(futures, answers):
+                if not future.done():
+                    future.set_result(answer)
+        finally:
+            self._running.release()
+
+    @staticmethod
+    def _fail(batch, error):
+        '''Fail queries of batch not yet answered with error.'''
+
+        for lat, lng, future, started in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def stats(self):
+        '''
+        Return counters of queries and batches,
+        and latency (s) percentiles of recent queries.
+        '''
+
+        if self.latencies:
+            p50, p99 = np.percentile(self.latencies, [50, 99]).tolist()
+        else:
+            p50 = p99 = None
+
+        return {'queries': self.queries,
+                'batches': self.batches,
+                'mean_batch': self.queries / max(self.batches, 1),
+                'largest_batch': self.largest_batch,
+                'p50_latency': p50,
+                'p99_latency': p99}
+
+    async def _respond(self, line):
+        '''Return response to one line of request.'''
+
+        # errors in the request itself are sent back here, and
+        # anything else is raised, for `handle()` to report loudly
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise TypeError('request must be a JSON object')
+            if request.get('stats'):
+                return self.stats()
+            lat, lng = float(request['lat']), float(request['lng'])
+        except (KeyError, ValueError, TypeError) as e:
+            return {'error': repr(e)}
+
+        neighbour, distance = await self.lookup(lat, lng)
+
+        # NaN isn't valid JSON, so a missing distance is null
+        if neighbour < 0:
+            return {'neighbour_index': -1, 'distance_km': None}
+
+        return {'neighbour_index': neighbour, 'distance_km': distance}
+
+    async def handle(self, reader, writer):
+        '''
+        Answer requests from one connection, in order, while letting
+        its later requests join batches before earlier ones are answered.
+        '''
+
+        responses = asyncio.Queue()
+
+        async def write():
+            loop = asyncio.get_running_loop()
+            while True:
+                response = await responses.get()
+                if response is None:
+                    break
+                try:
+                    response = await response
+                except Exception as e:
+                    # answer anyway, rather than leave the caller (and
+                    # every later caller) waiting, but log it here too
+                    loop.call_exception_handler({
+                        'message': 'query service failed to answer',
+                        'exception': e})
+                    response = {'error': repr(e)}
+                response = json.dumps(response, allow_nan=False)
+                writer.write(response.encode() + b'\n')
+                await writer.drain()
+
+        writing = asyncio.create_task(write())
+        try:
+            async for line in reader:
+                if line.strip():
+                    responses.put_nowait(asyncio.ensure_future(
+                        self._respond(line)))
+        finally:
+            responses.put_nowait(None)
+            await writing
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765, path=None):
+        '''
+        Return server answering queries on TCP host and port,
+        or Unix socket at path if given.
+        '''
+
+        if self._batcher is None:
+            await self.start()
+
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path=path)
+
+        return await asyncio.start_server(self.handle, host, port)
+
+
+class QueryClient():
+    '''
+    Client of `QueryService`, over one connection which any number
+    of tasks may query at once.
+    '''
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._waiting = deque()
+        self._reading = asyncio.create_task(self._read())
+
+    @classmethod
+    async def connect(cls, host='127.0.0.1', port=8765, path=None):
+        '''Connect to service on TCP host and port, or Unix socket.'''
+
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+
+        return cls(reader, writer)
+
+    async def _read(self):
+        '''Hand each response to the request waiting longest.'''
+
+        async for line in self.reader:
+            future = self._waiting.popleft()
+            if not future.done():
+                future.set_result(json.loads(line))
+
+        for future in self._waiting:
+            if not future.done():
+                future.set_exception(ConnectionError('service closed'))
+
+    async def _request(self, request):
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append(future)
+        self.writer.write(json.dumps(request).encode() + b'\n')
+        await self.writer.drain()
+
+        response = await future
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+
+        return response
+
+    async def query(self, lat, lng):
+        '''
+        Return (neighbour_index, distance_km) of nearest reference point
+        to point at (lat, lng), or (-1, None) if there is none.
+        '''
+
+        response = await self._request({'lat': lat, 'lng': lng})
+
+        return response['neighbour_index'], response['distance_km']
+
+    async def stats(self):
+        '''Return service's counters of latency and batch size.'''
+
+        return await self._request({'stats': True})
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        await self._reading
+
+
+if __name__ == '__main__':
+
+    import sys
+
+    if len(sys.argv) not in (2, 3):
+        sys.exit('usage: python -m opt_nn.service '
+                 'REFERENCE_FILE [PORT | SOCKET_PATH]')
+
+    from opt_nn.stream import read_chunks
+
+    reference = pd.concat(list(read_chunks(sys.argv[1],
+                                           columns=['lat', 'lng'])),
+                          ignore_index=True)
+    address = sys.argv[2] if len(sys.argv) == 3 else '8765'
+
+    async def main():
+        service = QueryService(ReferenceIndex(reference))
+        if address.isdigit():
+            server = await service.serve(port=int(address))
+        else:
+            server = await service.serve(path=address)
+        print(f'serving {len(reference)} points on {address}')
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
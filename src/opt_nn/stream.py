@@ -0,0 +1,138 @@
+'''
+Find nearest neighbours for point files too large to hold in memory
+as one dataframe.
+
+Only the reference points' x-y-z coordinates are held in memory (as a
+prebuilt 3-d tree); query points are read in fixed-size chunks, and
+each chunk's answers are written to the output file before the next
+chunk is read, so peak memory is bounded by the index plus one chunk.
+
+Point files may be CSV or Parquet (which needs `pyarrow`), with
+`lat` and `lng` columns in decimal degrees.
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from opt_nn.xyz import KDTree, cartesian, chord_to_km, nearest_in_tree
+
+
+def is_parquet(path):
+    '''Whether path is a Parquet (rather than CSV) file.'''
+
+    return os.fspath(path).endswith(('.parquet', '.pq'))
+
+
+def read_chunks(path, chunksize=100000, columns=None):
+    '''
+    Yield dataframes of at most chunksize rows from CSV or Parquet file,
+    with only the given columns (by default, all of them).
+    '''
+
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+
+        parquet = pq.ParquetFile(path)
+        for batch in parquet.iter_batches(batch_size=chunksize,
+                                          columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunksize, usecols=columns)
+
+
+def build_index(path, chunksize=100000, leafsize=16):
+    '''
+    Build 3-d tree of points in file, reading it in chunks
+    so that only the points' coordinates are held in memory.
+    '''
+
+    coords = [np.empty((0, 3))]
+    for chunk in read_chunks(path, chunksize, columns=['lat', 'lng']):
+        coords.append(cartesian(chunk))
+
+    return KDTree(np.concatenate(coords), leafsize=leafsize)
+
+
+def solve_chunks(chunks, tree, self_join=False):
+    '''
+    Yield each chunk of query points with `distance_km` and
+    `neighbour_index` (into reference points of tree) filled in.
+
+    For a self-join, where the chunks are the tree's own points
+    in order, each point's own index is excluded.
+    '''
+
+    offset = 0
+    for chunk in chunks:
+        points = cartesian(chunk)
+        chord, nearest = nearest_in_tree(tree, points, self_join, offset)
+        distance_km = np.where(nearest >= 0, chord_to_km(chord), np.nan)
+        chunk = chunk.assign(distance_km=distance_km,
+                             neighbour_index=nearest)
+        offset += len(chunk)
+
+        yield chunk
+
+
+def write_chunks(chunks, path):
+    '''
+    Write chunks of dataframe to CSV or Parquet file as they arrive,
+    returning total number of rows written.
+    '''
+
+    rows = 0
+    writer = None
+    try:
+        for i, chunk in enumerate(chunks):
+            if is_parquet(path):
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+            else:
+                chunk.to_csv(path, mode='w' if i == 0 else 'a',
+                             header=(i == 0), index=False)
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return rows
+
+
+def stream_nearest(query_path, output_path, reference_path=None,
+                   chunksize=100000, leafsize=16):
+    '''
+    Find nearest neighbour of each point in query file, out of the
+    points in reference file (by default, the query file itself,
+    in which case each point's own index is excluded), writing
+    `distance_km` and `neighbour_index` to output file chunk by chunk.
+
+    Returns total number of rows written.
+    '''
+
+    if reference_path is None:
+        reference_path = query_path
+    self_join = os.path.samefile(query_path, reference_path)
+
+    tree = build_index(reference_path, chunksize, leafsize)
+    chunks = read_chunks(query_path, chunksize)
+
+    return write_chunks(solve_chunks(chunks, tree, self_join), output_path)
+
+
+if __name__ == '__main__':
+
+    import sys
+
+    if len(sys.argv) not in (3, 4):
+        sys.exit('usage: python -m opt_nn.stream '
+                 'QUERY_FILE OUTPUT_FILE [REFERENCE_FILE]')
+
+    rows = stream_nearest(*sys.argv[1:3], *sys.argv[3:])
+    print(f'{rows} rows written to {sys.argv[2]}')
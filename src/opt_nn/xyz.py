@@ -5,24 +5,69 @@ to Cartesian x-y-z, as Euclidean metric in 3-D will give
 same nearest-neighbours as Haversine metric on the sphere.
 """
 
+import heapq
+import json
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
 from math import sqrt
 
 import pandas as pd
 import numpy as np
 
-from opt_nn.improved import h_distance
+from opt_nn.curve import curve_order
+from opt_nn.data import lat_lng, load
+from opt_nn.improved import R, haversine_array
+
+
+def cartesian(df):
+    '''
+    Return (n, 3) array of x-y-z coordinates on unit sphere
+    of dataframe's lat/lng points.
+    '''
+
+    lat, lng = lat_lng(df)
+    theta, phi = np.radians(lng), np.radians(lat)
+
+    points = np.empty((len(lat), 3))
+    cos_phi = np.cos(phi)
+    np.multiply(np.cos(theta), cos_phi, out=points[:, 0])
+    np.multiply(np.sin(theta), cos_phi, out=points[:, 1])
+    np.sin(phi, out=points[:, 2])
+
+    return points
 
 
 def transform_coords(df):
-    '''Transform lat/lng to cartesian'''
+    '''
+    Transform lat/lng to cartesian, returning dataframe with x, y
+    and z columns added (which shares the rest of df's columns).
+    '''
 
-    df = df.copy()
-    df[["theta", "phi"]] = np.radians(df[["lng", "lat"]])
-    df["x"] = np.cos(df.theta) * np.cos(df.phi)
-    df["y"] = np.sin(df.theta) * np.cos(df.phi)
-    df["z"] = np.sin(df.phi)
+    points = cartesian(df)
 
-    return df
+    return df.assign(x=points[:, 0], y=points[:, 1], z=points[:, 2])
+
+
+def chord_to_km(chord):
+    '''
+    Convert Euclidean distance between points on unit sphere
+    to great-circle distance in km on surface of earth.
+    '''
+
+    return 2 * R * np.arcsin(np.minimum(np.asarray(chord) / 2, 1))
+
+
+def km_to_chord(km):
+    '''
+    Convert great-circle distance in km on surface of earth
+    to Euclidean distance between points on unit sphere.
+    '''
+
+    return 2 * np.sin(np.minimum(np.asarray(km, dtype=np.float64) / (2 * R),
+                                 np.pi / 2))
 
 
 def euclidean(p1, p2, square_root=False):
@@ -51,15 +96,88 @@ def make_point_list(dataframe):
     to list of Points.
     '''
 
-    df = dataframe.copy()
-    df = transform_coords(df)
-    return list(df.apply(lambda x: CartesianPoint(x), axis=1))
+    points = cartesian(dataframe)
+    return [CartesianPoint.from_coords(name, x, y, z)
+            for name, (x, y, z) in zip(dataframe.index, points)]
+
+
+class DistanceCache():
+    '''
+    Bounded cache of squared distances between pairs of points,
+    evicting the least recently used pair once full,
+    and counting hits and misses to show whether it is worth having.
+    '''
+
+    def __init__(self, maxsize=2**16):
+        '''
+        Create empty cache holding at most maxsize distances.
+        '''
+
+        self.maxsize = maxsize
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def __repr__(self):
+        return (f'DistanceCache({len(self)}/{self.maxsize}, '
+                f'hits={self.hits}, misses={self.misses})')
+
+    @property
+    def hit_rate(self):
+        '''Fraction of lookups which were hits.'''
+
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def lookup(self, p1, p2):
+        '''
+        Return squared distance between points,
+        calculating it only if not already cached.
+        '''
+
+        # key on points themselves (hashed by identity, and held by the
+        # table, so never reused), since names repeat across dataframes;
+        # distance is symmetric, so store each pair only once
+        key = (p1, p2) if id(p1) <= id(p2) else (p2, p1)
+
+        if key in self.table:
+            self.hits += 1
+            self.table.move_to_end(key)
+            return self.table[key]
+
+        self.misses += 1
+        distance = euclidean(p1, p2)
+        self.table[key] = distance
+        if len(self.table) > self.maxsize:
+            self.table.popitem(last=False)
+
+        return distance
+
+    def clear(self):
+        '''Empty cache and reset counters.'''
+
+        self.table.clear()
+        self.hits = 0
+        self.misses = 0
 
 
 class CartesianPoint():
     '''
     Point in Cartesian 3-D space.
+
+    Points have fixed slots rather than a `__dict__`, so there may be
+    millions of them. Distances are calculated afresh each time, which
+    is cheaper than hashing, unless `CartesianPoint.cache` is set to a
+    `DistanceCache` shared by all points.
     '''
+
+    __slots__ = ('name', 'x', 'y', 'z')
+
+    cache = None
+
     def __init__(self, row=None):
         '''
         Create point from pandas row.
@@ -69,7 +187,20 @@ class CartesianPoint():
         self.x = row.x
         self.y = row.y
         self.z = row.z
-        self.sq_distances = dict()
+
+    @classmethod
+    def from_coords(cls, name, x, y, z):
+        '''
+        Create point from name and coordinates, without a pandas row.
+        '''
+
+        point = cls.__new__(cls)
+        point.name = name
+        point.x = float(x)
+        point.y = float(y)
+        point.z = float(z)
+
+        return point
 
     def __repr__(self):
         '''
@@ -86,103 +217,1394 @@ class CartesianPoint():
         Return squared distance to other point.
         '''
 
-        if not point in self.sq_distances.keys():
-            self.sq_distances[point] = euclidean(self, point)
+        if self.cache is None:
+            return euclidean(self, point)
 
-        return self.sq_distances[point]
+        return self.cache.lookup(self, point)
+
+
+def count_nodes(n, leafsize):
+    '''
+    Return number of nodes in kd-tree of n points,
+    splitting on median until at most leafsize points remain.
+    '''
+
+    if n == 0:
+        return 0
+
+    # at each depth there are at most two different node sizes
+    total = 0
+    sizes = {n: 1}
+    while sizes:
+        below = dict()
+        for size, count in sizes.items():
+            total += count
+            if size > leafsize:
+                for half in (size // 2, size - size // 2):
+                    below[half] = below.get(half, 0) + count
+        sizes = below
+
+    return total
+
+
+def leaf_depths(tree):
+    '''Return depth of each leaf of tree (root is at depth 0).'''
+
+    depths = []
+    nodes = np.zeros(1 if tree.n else 0, dtype=np.intp)
+    depth = 0
+    while len(nodes):
+        leaf = tree.left[nodes] < 0
+        depths.append(np.full(leaf.sum(), depth))
+        nodes = nodes[~leaf]
+        nodes = np.concatenate([tree.left[nodes], tree.right[nodes]])
+        depth += 1
+
+    return np.concatenate([np.empty(0, dtype=int)] + depths)
+
+
+class TreeStats():
+    '''
+    Counters of the work done building and searching a tree,
+    to show whether a slow search is down to the data (clustered
+    points making deep, unbalanced trees and poor pruning) or just
+    to the number of points.
+
+    Nothing is counted unless a `TreeStats` is given to the tree
+    (as `KDTree(points, stats=...)`, or by setting `tree.stats`).
+    '''
+
+    def __init__(self):
+        '''Create empty counters.'''
+
+        # seconds spent partitioning nodes at each depth of build
+        self.build_seconds = []
+        # number of leaves at each depth, once built
+        self.depths = np.zeros(0, dtype=int)
+
+        # nodes visited by each query, as arrays for each batch
+        self.visits = []
+        # point-to-point distances calculated, and branches skipped
+        self.distances = 0
+        self.pruned = 0
+
+    def __repr__(self):
+        return (f'TreeStats(queries={self.queries}, '
+                f'distances={self.distances}, pruned={self.pruned})')
+
+    def record_build(self, depth, seconds):
+        '''Add time taken partitioning a node at given depth.'''
+
+        if depth >= len(self.build_seconds):
+            self.build_seconds += [0.0] * (depth + 1 - len(self.build_seconds))
+        self.build_seconds[depth] += seconds
+
+    def record_search(self, visits, distances=0, pruned=0):
+        '''
+        Add nodes visited by each of a batch of queries (array, or
+        count for a single query), and distances calculated and
+        branches pruned by the batch.
+        '''
+
+        self.visits.append(np.atleast_1d(visits))
+        self.distances += int(distances)
+        self.pruned += int(pruned)
+
+    @property
+    def queries(self):
+        '''Number of queries recorded.'''
+
+        return sum(len(visits) for visits in self.visits)
+
+    @property
+    def prune_rate(self):
+        '''Fraction of branches considered which were pruned.'''
+
+        visited = sum(int(visits.sum()) for visits in self.visits)
+        considered = visited + self.pruned
+        return self.pruned / considered if considered else 0.0
+
+    def summary(self):
+        '''Return dict of build and search statistics.'''
+
+        visits = np.concatenate([np.zeros(0)] + self.visits)
+        queries = max(len(visits), 1)
+        depth = np.repeat(np.arange(len(self.depths)), self.depths)
+        has = len(visits) > 0, len(depth) > 0
+
+        return {
+            'build_s': float(sum(self.build_seconds)),
+            'depth_min': int(depth.min()) if has[1] else 0,
+            'depth_max': int(depth.max()) if has[1] else 0,
+            'depth_mean': float(depth.mean()) if has[1] else 0.0,
+            'queries': len(visits),
+            'visits_mean': float(visits.mean()) if has[0] else 0.0,
+            'visits_p99': float(np.percentile(visits, 99)) if has[0] else 0.0,
+            'visits_max': int(visits.max()) if has[0] else 0,
+            'distances_per_query': self.distances / queries,
+            'prune_rate': self.prune_rate,
+        }
+
+
+# identifies files written by `KDTree.save()`
+FILE_MAGIC = b"OPTNN-KDTREE"
+FILE_VERSION = 1
+FILE_ALIGNMENT = 64
+
+# compact coordinates: each of x, y, z in [-1, 1] as an int32 step
+QUANTUM = 2 / (2**31 - 1)
 
 
 class KDTree:
     """
-    Recursive spatial index built 
-    by cycling through dimensional axes
-    and splitting on median point.
+    Spatial index built by cycling through dimensional axes
+    and splitting on the median point.
+
+    Rather than a tree of Python objects, the points are kept in one
+    contiguous (n, 3) float64 array, and the nodes are stored as
+    parallel arrays indexed by node number (root is node 0):
+
+        axis, split -- dimension and value each internal node splits on
+        left, right -- child node numbers (-1 for a leaf)
+        start, end  -- slice of `index` holding the node's points
+
+    `index` is a permutation of the point indices, partitioned in
+    place so that every node's points are contiguous. Splitting stops
+    once a node holds no more than `leafsize` points: each leaf is a
+    bucket which is searched with one vectorized distance calculation,
+    which is much cheaper than a Python call per point.
+
+    A `compact` tree stores coordinates as 'float32', or as 'int32'
+    steps of `QUANTUM` across [-1, 1], and its index and node arrays as
+    int32, taking about half the memory. Distances are then only
+    approximate (to within the tree's `error`, about 1e-7 or 1e-9 of
+    the sphere's radius), so callers should re-rank candidates with
+    exact coordinates, as `rerank()` does.
     """
 
     axes = ("x", "y", "z")
 
-    def __init__(self, points_list, depth=0):
-        """Create new (branch of) tree with list of points."""
+    # everything needed to search tree, so it can be shared or stored
+    arrays = ("data", "index", "axis", "split",
+              "left", "right", "start", "end")
+
+    # `TreeStats` counting work done, if wanted
+    stats = None
+
+    # if built by `workers`, specs of its arrays in shared memory
+    # (see `parallel.shared_empty()`), for other processes to view
+    shared = None
 
-        # meant to take list of points, not dataframe,
+    def __init__(self, points, leafsize=16, compact=None, stats=None,
+                 workers=None):
+        """
+        Create new tree from (n, 3) array or dataframe of points,
+        optionally compact (with 'float32' or 'int32' coordinates),
+        and recording build and search statistics in `stats`,
+        built by `workers` processes (by default, just this one).
+        """
+
+        # meant to take an array of points, not dataframe,
         # but since given.slow() takes a df this might be helpful.
-        if isinstance(points_list, pd.DataFrame):
-            points_list = make_point_list(points_list)
+        if isinstance(points, pd.DataFrame):
+            if set(self.axes).issubset(points.columns):
+                points = points[list(self.axes)].to_numpy()
+            else:
+                points = cartesian(points)
+
+        if leafsize < 1:
+            raise ValueError("leafsize must be at least 1")
+
+        points = np.asarray(points, dtype=np.float64)
+        if compact is None:
+            self.data = np.ascontiguousarray(points)
+        elif compact == "float32":
+            self.data = np.ascontiguousarray(points, dtype=np.float32)
+        elif compact == "int32":
+            steps = np.rint((np.clip(points, -1, 1) + 1) / QUANTUM)
+            self.data = np.ascontiguousarray(steps, dtype=np.int32)
+        else:
+            raise ValueError("compact must be None, 'float32' or 'int32'")
+
+        self.n = len(self.data)
+        self.leafsize = leafsize
+        self.stats = stats
+        self._build(workers)
+
+    @property
+    def compact(self):
+        """How coordinates are compacted, if at all."""
+
+        return {"f8": None, "f4": "float32", "i4": "int32"}[
+            self.data.dtype.str[1:]]
+
+    @property
+    def error(self):
+        """
+        Bound on Euclidean distance between any point's coordinates
+        as stored and as given, on the unit sphere.
+        """
 
-        n = len(points_list)
-        self.depth = depth
-        self.axis = self.axes[depth % len(self.axes)]
+        # a whole step per axis (float32 epsilon, for coordinates no
+        # more than 1) rather than the half step of rounding to it,
+        # to allow for rounding in float64 arithmetic as well
+        step = {None: 0.0, "float32": np.finfo(np.float32).eps,
+                "int32": QUANTUM}[self.compact]
 
-        if n > 0:
-            sorted_points = sorted(points_list,
-                                   key=lambda x: getattr(x, self.axis))
+        return sqrt(3) * step
 
-            self.node = sorted_points[n // 2]
-            self.left = KDTree(sorted_points[:n // 2], self.depth + 1)
-            self.right = KDTree(sorted_points[n // 2 + 1:], self.depth + 1)
+    def coords(self, ids=slice(None)):
+        """Return float64 coordinates of points with given ids."""
+
+        data = self.data[ids]
+        if data.dtype == np.int32:
+            return data * QUANTUM - 1
+
+        return data.astype(np.float64, copy=False)
+
+    def _build(self, workers=None):
+        """
+        Partition points on median of each axis in turn.
+
+        Each split is an `argpartition` of the node's own slice of
+        `index`, so every level does O(n) work in total and the
+        whole build is O(n log n).
+
+        Given `workers`, the tree is built in arrays made in shared
+        memory from the start (see `parallel.build_subtrees()`), and
+        with more than one, only the top few levels are split here,
+        and the subtrees below are built by a pool of processes.
+        """
+
+        n = self.n
+
+        if workers is None:
+            self._allocate()
+            if n:
+                self._split(0, n, 0, 0)
         else:
-            self.node = None
+            from opt_nn.parallel import build_subtrees
+
+            self.shared = build_subtrees(self, workers)
+
+        if self.stats is not None and n:
+            self.stats.depths = np.bincount(leaf_depths(self))
+
+    def _allocate(self, empty=None):
+        """
+        Make index and node arrays, as for a tree not yet built,
+        with `empty(name, size, dtype)` if given (to put them in
+        shared memory, say), otherwise `numpy.empty`.
+        """
+
+        n = self.n
+        n_nodes = count_nodes(n, self.leafsize)
+
+        # compact trees don't need 64-bit indices
+        dtype = np.intp if self.compact is None else np.int32
+
+        for name, size, dtype, fill in (
+                ("index", n, dtype, np.arange(n)),
+                ("axis", n_nodes, np.int8, 0),
+                ("split", n_nodes, np.float64, 0),
+                ("left", n_nodes, dtype, -1),
+                ("right", n_nodes, dtype, -1),
+                ("start", n_nodes, dtype, 0),
+                ("end", n_nodes, dtype, 0)):
+            if empty is None:
+                array = np.empty(size, dtype=dtype)
+            else:
+                array = empty(name, size, dtype)
+            array[...] = fill
+            setattr(self, name, array)
+
+    def _split(self, start, end, depth, first, max_depth=None):
+        """
+        Build subtree of points index[start:end] at depth, numbering
+        its nodes from first, and return list of (start, end, depth,
+        node) of subtrees left unbuilt below max_depth (if given).
+
+        Nodes are numbered in depth-first (pre-)order, so any subtree's
+        nodes can be numbered without building the rest of the tree.
+        """
+
+        stats = self.stats
+
+        count = first
+        frontier = []
+        stack = [(start, end, depth, -1, None)]
+        while stack:
+            start, end, depth, parent, children = stack.pop()
+
+            node = count
+            if parent >= 0:
+                children[parent] = node
+
+            # leave deeper subtrees, but save room for their nodes
+            if (max_depth is not None and depth >= max_depth
+                    and end - start > self.leafsize):
+                frontier.append((start, end, depth, node))
+                count += count_nodes(end - start, self.leafsize)
+                continue
+
+            count += 1
+            self.start[node] = start
+            self.end[node] = end
+
+            if end - start <= self.leafsize:
+                continue
+
+            if stats is not None:
+                t0 = time.perf_counter()
+
+            axis = depth % self.data.shape[1]
+            mid = start + (end - start) // 2
+            segment = self.index[start:end]
+            order = np.argpartition(self.data[segment, axis], mid - start)
+            self.index[start:end] = segment[order]
+
+            self.axis[node] = axis
+            self.split[node] = self.coords(self.index[mid])[axis]
+
+            if stats is not None:
+                stats.record_build(depth, time.perf_counter() - t0)
 
+            # push right first so that left is numbered next
+            stack.append((mid, end, depth + 1, node, self.right))
+            stack.append((start, mid, depth + 1, node, self.left))
 
-    def knn(self, point, k=2, nearest=None):
+        return frontier
+
+    @classmethod
+    def from_arrays(cls, leafsize, **arrays):
         '''
-        Return k nearest neighbours for given point, 
-        including identical point.
+        Recreate tree from its (possibly shared) `arrays`
+        without building it again.
         '''
 
-        # start by making a list to store nearest so far
-        if nearest is None:
-            nearest = [None] * k
+        tree = cls.__new__(cls)
+        for name in cls.arrays:
+            setattr(tree, name, arrays[name])
+        tree.n = len(tree.data)
+        tree.leafsize = leafsize
 
-        # if node is None we have reached end of the branch
-        if self.node is None:
-            return nearest
-        else:
+        return tree
+
+    def save(self, path):
+        '''
+        Write tree to file at path, in a versioned binary format
+        which `KDTree.load()` can memory-map.
+
+        The file starts with `FILE_MAGIC`, then the format version and
+        length of a JSON header (as little-endian uint32s), then the
+        header itself, describing each array's dtype, shape and offset.
+        The arrays follow, each aligned to `FILE_ALIGNMENT` bytes.
+        '''
+
+        arrays = [np.ascontiguousarray(getattr(self, name))
+                  for name in self.arrays]
+
+        def aligned(offset):
+            return -(-offset // FILE_ALIGNMENT) * FILE_ALIGNMENT
+
+        # header length depends on offsets, which depend on header length,
+        # so allow generous fixed space for the header
+        data_start = aligned(len(FILE_MAGIC) + 8 + 1024 * len(arrays))
+
+        entries = []
+        offset = data_start
+        for name, array in zip(self.arrays, arrays):
+            entries.append({"name": name, "dtype": array.dtype.str,
+                            "shape": list(array.shape), "offset": offset})
+            offset = aligned(offset + array.nbytes)
+
+        header = json.dumps({"leafsize": int(self.leafsize),
+                             "arrays": entries}).encode()
+        if len(FILE_MAGIC) + 8 + len(header) > data_start:
+            raise ValueError(f"header of {len(header)} bytes is too long "
+                             f"for space left before data")
+
+        with open(path, "wb") as f:
+            f.write(FILE_MAGIC)
+            f.write(struct.pack("<II", FILE_VERSION, len(header)))
+            f.write(header)
+            for entry, array in zip(entries, arrays):
+                f.seek(entry["offset"])
+                # write array's own buffer, without copying it to bytes
+                f.write(array.reshape(-1).view(np.uint8))
+            f.truncate(offset)
 
-            # if current node is not yet in the nearest list
-            # and is nearer than the furthest nearest neighbour
-            # then replace it
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Read tree written by `KDTree.save()`.
+
+        With `mmap`, arrays are memory-mapped read-only rather than
+        read into memory, so loading is near-instant and processes
+        loading the same file share the same pages.
+        '''
+
+        with open(path, "rb") as f:
+            if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+                raise ValueError(f"{path} is not a saved KDTree")
+            version, header_length = struct.unpack("<II", f.read(8))
+            if version != FILE_VERSION:
+                raise ValueError(f"{path} has unsupported format version "
+                                 f"{version} (expected {FILE_VERSION})")
+            header = json.loads(f.read(header_length))
+
+            arrays = dict()
+            for entry in header["arrays"]:
+                dtype = np.dtype(entry["dtype"])
+                shape = tuple(entry["shape"])
+                count = int(np.prod(shape))
+
+                # can't memory-map empty arrays
+                if mmap and count:
+                    array = np.memmap(path, dtype=dtype, mode="r",
+                                      offset=entry["offset"], shape=shape)
+                else:
+                    f.seek(entry["offset"])
+                    array = np.fromfile(f, dtype=dtype, count=count)
+                    array = array.reshape(shape)
+                arrays[entry["name"]] = array
+
+        return cls.from_arrays(header["leafsize"], **arrays)
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def nbytes(self):
+        """Memory used by point and node arrays."""
+
+        return sum(getattr(self, name).nbytes for name in self.arrays)
+
+    def levels(self):
+        '''
+        Return list of arrays of internal nodes at each depth of tree,
+        from the root down.
+        '''
 
-            if self.node not in nearest and \
-                    point.dist(self.node) < point.dist(nearest[-1]):
-                nearest = nearest[:-1] + [self.node]
-                nearest = sorted(nearest, key=lambda x: point.dist(x))[:k]
+        levels = []
+        nodes = np.zeros(1 if self.n else 0, dtype=np.intp)
+        while len(nodes):
+            nodes = nodes[self.left[nodes] >= 0]
+            levels.append(nodes)
+            nodes = np.concatenate([self.left[nodes], self.right[nodes]])
+
+        return levels
+
+    def reduce_nodes(self, values, ufunc=np.maximum, levels=None):
+        '''
+        Return reduction by ufunc (such as `np.maximum`) of values
+        (one row for each point in tree) of points under each node,
+        given tree's `levels()`, if already found.
+
+        Leaves are reduced over their slices of index, then internal
+        nodes from the deepest up, so this takes O(n) in all.
+        '''
+
+        values = np.asarray(values)
+        result = np.zeros((len(self.left),) + values.shape[1:])
+        if self.n == 0:
+            return result
+
+        # leaves' slices of index are contiguous, and in order
+        leaves = np.flatnonzero(self.left < 0)
+        result[leaves] = ufunc.reduceat(values[self.index],
+                                        self.start[leaves])
+
+        if levels is None:
+            levels = self.levels()
+        for nodes in reversed(levels):
+            result[nodes] = ufunc(result[self.left[nodes]],
+                                  result[self.right[nodes]])
+
+        return result
+
+    def knn(self, point, k=2):
+        '''
+        Return (distances, indices) arrays of k nearest neighbours
+        for given point, including identical point.
+
+        Nearest so far are kept in a bounded max-heap, and a branch is
+        skipped if its box is further away than the k-th nearest so far,
+        where the distance to the box is updated one axis at a time as
+        the search crosses each splitting plane.
+        (For many points at once, `query_batch()` is much faster.)
+        '''
+
+        if k < 1:
+            raise ValueError("k must be at least 1")
+
+        if isinstance(point, CartesianPoint):
+            point = (point.x, point.y, point.z)
+        point = np.asarray(point, dtype=np.float64)
+
+        # k nearest so far, as (-squared distance, -index), so that the
+        # furthest (and of equally far, the last) is at top of heap
+        heap = []
+
+        # branches still to search, with squared distance to their box
+        # and offset from point to box along each axis
+        stack = [(0, 0.0, (0.0,) * len(point))] if self.n else []
+
+        # only count work if recording it
+        stats = self.stats
+        if stats is not None:
+            visits = distances = pruned = 0
+
+        while stack:
+            node, box_sq, offsets = stack.pop()
+
+            # skip branch if box is further than furthest nearest
+            if len(heap) == k and box_sq > -heap[0][0]:
+                if stats is not None:
+                    pruned += 1
+                continue
+            if stats is not None:
+                visits += 1
+
+            # if node is a leaf, compare its points to nearest so far
+            if self.left[node] < 0:
+                bucket = self.index[self.start[node]:self.end[node]]
+                if stats is not None:
+                    distances += len(bucket)
+                sq_distances = ((self.coords(bucket) - point) ** 2)
+                sq_distances = sq_distances.sum(axis=1)
+                for d, i in zip(sq_distances.tolist(), bucket.tolist()):
+                    if len(heap) < k:
+                        heapq.heappush(heap, (-d, -i))
+                    elif (-d, -i) > heap[0]:
+                        heapq.heapreplace(heap, (-d, -i))
+                continue
 
             # get next branch
-            boundary_diff = \
-                getattr(point, self.axis) - getattr(self.node, self.axis)
+            axis = self.axis[node]
+            boundary_diff = point[axis] - self.split[node]
             if boundary_diff < 0:
-                next_branch, opposite = self.left, self.right
+                next_branch, opposite = self.left[node], self.right[node]
             else:
-                next_branch, opposite = self.right, self.left
+                next_branch, opposite = self.right[node], self.left[node]
+
+            # opposite box is now at least boundary_diff away along axis
+            opposite_offsets = list(offsets)
+            opposite_offsets[axis] = boundary_diff
+            opposite_sq = box_sq - offsets[axis] ** 2 + boundary_diff ** 2
+
+            # search next_branch first, then opposite if necessary
+            stack.append((opposite, opposite_sq, tuple(opposite_offsets)))
+            stack.append((next_branch, box_sq, offsets))
 
-            # find nearest neighbours on next_branch
-            nearest = next_branch.knn(point, k, nearest)
+        if stats is not None:
+            stats.record_search(visits, distances, pruned)
 
-            # if necessary, check on opposite branch
-            if point.dist(nearest[-1]) >= abs(boundary_diff) ** 2:
-                nearest = opposite.knn(point, k, nearest)
+        nearest = sorted((-d, -i) for d, i in heap)
+        nearest += [(np.inf, -1)] * (k - len(nearest))
 
-        return nearest
+        distances, indices = zip(*nearest)
+        return np.sqrt(distances), np.array(indices)
 
+    def query_batch(self, points, k=1, batch_size=16384, eps=0.0,
+                    max_leaves=None):
+        '''
+        Return (distances, indices) arrays of shape (m, k) giving
+        k nearest neighbours for each of (m, 3) array of points,
+        including identical point.
 
-def use_3dtree(df):
-    """Use 3-dimensional k-d tree to give solution"""
+        Queries are processed together, `batch_size` at a time: each
+        is first compared with the smallest branch around it holding
+        at least k points, then the whole batch descends the tree one
+        level at a time, discarding every (query, branch) pair whose
+        branch is further away than the query's k-th nearest so far.
 
-    df = transform_coords(df)
+        The search is approximate if `eps` > 0, when branches are also
+        discarded if they are further than the k-th nearest so far
+        divided by (1 + eps), so that each distance found is within a
+        factor (1 + eps) of the true one; or if `max_leaves` is given,
+        when no more than that many leaves are searched for each query
+        beyond the branch around it.
+        '''
 
-    # make point list from dataframe
-    points = make_point_list(df)
+        return query_blocks(self, points, k, batch_size, eps=eps,
+                            max_leaves=max_leaves)
 
-    # then construct kd-tree
-    tree = KDTree(points)
+    def _descend(self, points, k):
+        '''
+        Return deepest node on each point's path with at least k points.
+        '''
+
+        node = np.zeros(len(points), dtype=np.intp)
+        active = np.flatnonzero(self.left[node] >= 0)
+        while len(active):
+            current = node[active]
+            below = points[active, self.axis[current]] < self.split[current]
+            child = np.where(below, self.left[current], self.right[current])
+            deeper = self.end[child] - self.start[child] >= k
+            node[active[deeper]] = child[deeper]
+            active = active[deeper]
+            active = active[self.left[node[active]] >= 0]
+
+        return node
+
+    def _query_block(self, points, sq_distances, indices, eps=0.0,
+                     max_leaves=None):
+        '''
+        Fill in squared distances and indices of nearest neighbours
+        for one block of query points (approximately, given `eps` or
+        `max_leaves`, as described in `query_batch()`).
+        '''
+
+        m, k = sq_distances.shape
+
+        # start with everything in the branch around each point
+        home = self._descend(points, k)
+        self._compare(points, np.arange(m), home, sq_distances, indices)
+
+        shrink = 1 / (1 + eps) ** 2
+
+        if max_leaves is None:
+            def bound(query, node):
+                return sq_distances[query, -1] * shrink
+        else:
+            # queries which have searched max_leaves look no further
+            searched = np.zeros(m, dtype=np.intp)
+
+            def bound(query, node):
+                return np.where(searched[query] < max_leaves,
+                                sq_distances[query, -1] * shrink, -1.0)
+
+        # then search leaves that might hold anything nearer,
+        # ignoring those within home branch, which we have already seen
+        for query, node in self._leaves_near(points, bound, seen=home):
+            if max_leaves is not None:
+                # within this level, take each query's first few leaves
+                order = np.argsort(query, kind="stable")
+                first = np.searchsorted(query[order], query[order])
+                rank = np.empty(len(query), dtype=np.intp)
+                rank[order] = np.arange(len(query)) - first
+                keep = searched[query] + rank < max_leaves
+                query, node = query[keep], node[keep]
+                searched += np.bincount(query, minlength=m)
+                if not len(query):
+                    continue
+
+            self._compare(points, query, node, sq_distances, indices)
+
+    def _leaves_near(self, points, bound, seen=None, inclusive=False):
+        '''
+        Yield (query, leaf) pairs of arrays, one tree level at a time,
+        for every leaf whose region is nearer than squared distance
+        bound(query, node) to query point (or no further, if inclusive),
+        skipping leaves within the branch seen[query], if given.
+
+        Bounds are checked again at every level, so they may shrink
+        as yielded leaves are searched. A nearest-neighbour search must
+        not be inclusive: with many identical points the bound is 0,
+        and every region at distance 0 would be searched.
+        '''
+
+        m = len(points)
+        if seen is not None:
+            seen_start, seen_end = self.start[seen], self.end[seen]
+
+        # track each pair's distance to node's region along every axis
+        query = np.arange(m)
+        node = np.zeros(m, dtype=np.intp)
+        offset = np.zeros((m, self.data.shape[1]))
+
+        stats = self.stats
+        if stats is not None:
+            visits = np.zeros(m, dtype=int)
+            pruned = 0
+
+        while len(query):
+            if stats is not None:
+                visits += np.bincount(query, minlength=m)
+
+            split = self.left[node] >= 0
+            if seen is not None:
+                unseen = ~((self.start[node] >= seen_start[query])
+                           & (self.end[node] <= seen_end[query]))
+                split &= unseen
+                leaf = ~split & unseen
+            else:
+                leaf = ~split
 
-    # then use to find nearest neighbours
-    df.neighbour_index = df.apply(
-        lambda x: tree.knn(CartesianPoint(x))[1].name, axis=1)
+            if leaf.any():
+                yield query[leaf], node[leaf]
 
-    # then find spherical distance using haversine formula
-    df.distance_km = df.apply(
-        lambda x: h_distance(x, df.iloc[x.neighbour_index]), axis=1)
+            query, node, offset = query[split], node[split], offset[split]
+
+            # split each pair into next_branch and opposite
+            axis = self.axis[node]
+            boundary_diff = points[query, axis] - self.split[node]
+            below = boundary_diff < 0
+            next_branch = np.where(below, self.left[node], self.right[node])
+            opposite = np.where(below, self.right[node], self.left[node])
+
+            opposite_offset = offset.copy()
+            opposite_offset[np.arange(len(query)), axis] = boundary_diff
+
+            query = np.concatenate([query, query])
+            node = np.concatenate([next_branch, opposite])
+            offset = np.concatenate([offset, opposite_offset])
+
+            # keep pairs whose region is within bound
+            if inclusive:
+                keep = (offset ** 2).sum(axis=1) <= bound(query, node)
+            else:
+                keep = (offset ** 2).sum(axis=1) < bound(query, node)
+            query, node, offset = query[keep], node[keep], offset[keep]
+
+            if stats is not None:
+                pruned += len(keep) - len(query)
+
+        if stats is not None:
+            stats.record_search(visits, pruned=pruned)
+
+    def query_within(self, points, radius):
+        '''
+        Return (query, index, distance) arrays giving every pair of
+        query point and tree point within Euclidean distance radius
+        (a scalar, or one radius for each of (m, 3) array of points).
+        '''
+
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        points = points.reshape(-1, self.data.shape[1])
+        sq_radius = np.broadcast_to(np.square(radius, dtype=np.float64),
+                                    len(points))
+
+        pairs = [(np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp),
+                  np.empty(0))]
+        if self.n:
+            leaves = self._leaves_near(points, lambda q, _: sq_radius[q],
+                                       inclusive=True)
+            for query, node in leaves:
+                query, candidate = self._gather(query, node)
+                if self.stats is not None:
+                    self.stats.distances += len(candidate)
+                distance = ((points[query] - self.coords(candidate)) ** 2)
+                distance = distance.sum(axis=1)
+                within = distance <= sq_radius[query]
+                pairs.append((query[within], candidate[within],
+                              distance[within]))
+
+        query, index, sq_distance = map(np.concatenate, zip(*pairs))
+
+        return query, index, np.sqrt(sq_distance)
+
+    def query_radius(self, points, r_km):
+        '''
+        Return (query, index, distance_km) arrays giving every pair of
+        query point and tree point within great-circle distance r_km
+        (a scalar, or one radius for each of (m, 3) array of points),
+        sorted by query and then by distance.
+        '''
+
+        query, index, chord = self.query_within(points, km_to_chord(r_km))
+        order = np.lexsort((index, chord, query))
+
+        return query[order], index[order], chord_to_km(chord[order])
+
+    def _gather(self, query, node):
+        '''
+        Flatten (query, node) pairs into (query, point) pairs
+        for all points in each node.
+        '''
+
+        return gather(query, node, self.start, self.end, self.index)
+
+    def _compare(self, points, query, node, sq_distances, indices):
+        '''
+        Compare each query point with all points in its paired node,
+        keeping the k nearest found so far.
+        '''
+
+        if self.stats is not None:
+            self.stats.distances += int(
+                (self.end[node] - self.start[node]).sum())
+        candidate, padding = self.node_rows(node)
+
+        distance = ((points[query, None, :] - self.coords(candidate)) ** 2)
+        distance = distance.sum(axis=2)
+        distance[padding] = np.inf
+
+        merge_rows(sq_distances, indices, query, distance, candidate)
+
+    def node_rows(self, node):
+        '''
+        Return (points, padding) arrays gathering the points of each
+        node into a row, padded to the widest node with index -1,
+        where padding is True.
+        '''
+
+        start, end = self.start[node], self.end[node]
+        position = start[:, None] + np.arange((end - start).max())
+        padding = position >= end[:, None]
+        points = self.index[np.minimum(position, self.n - 1)]
+        points[padding] = -1
+
+        return points, padding
+
+
+def query_blocks(index, points, k, batch_size=16384, **options):
+    '''
+    Return (distances, indices) arrays of shape (m, k) giving
+    k nearest neighbours in index (such as a `KDTree`) for each of
+    (m, 3) array of points, searched `batch_size` at a time by
+    `index._query_block(points, sq_distances, indices, **options)`.
+    '''
+
+    if k < 1:
+        raise ValueError("k must be at least 1")
+
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    points = points.reshape(-1, index.data.shape[1])
+    m = len(points)
+
+    distances = np.full((m, k), np.inf)
+    indices = np.full((m, k), -1)
+
+    if index.n:
+        for lo in range(0, m, batch_size):
+            hi = min(lo + batch_size, m)
+            index._query_block(points[lo:hi], distances[lo:hi],
+                               indices[lo:hi], **options)
+
+    return np.sqrt(distances), indices
+
+
+def gather(query, node, start, end, index):
+    '''
+    Flatten (query, node) pairs into (query, point) pairs
+    for all points index[start[node]:end[node]] of each node.
+    '''
+
+    counts = end[node] - start[node]
+    pair = np.repeat(np.arange(len(query)), counts)
+    position = (np.arange(len(pair))
+                - np.repeat(np.cumsum(counts) - counts, counts)
+                + start[node][pair])
+
+    return query[pair], index[position]
+
+
+def merge_rows(distances, indices, query, distance, candidate):
+    '''
+    Merge rows of candidate neighbours into (m, k) arrays of nearest
+    so far, as `merge_nearest()`, first keeping only the k nearest
+    in each row, and only rows with any nearer than k-th nearest.
+    '''
+
+    k = distances.shape[1]
+
+    # only k nearest in each row can matter
+    if distance.shape[1] > k:
+        nearest = np.argpartition(distance, k - 1, axis=1)[:, :k]
+        distance = np.take_along_axis(distance, nearest, axis=1)
+        candidate = np.take_along_axis(candidate, nearest, axis=1)
+
+    # most rows are no nearer than k-th nearest so far
+    closer = distance.min(axis=1) < distances[query, -1]
+    if closer.any():
+        merge_nearest(distances, indices, query[closer],
+                      distance[closer], candidate[closer])
+
+
+def merge_nearest(distances, indices, query, distance, candidate):
+    '''
+    Merge candidate neighbours into (m, k) arrays of nearest so far,
+    where row candidate[j] is at distances distance[j] from query[j].
+    '''
+
+    k = distances.shape[1]
+
+    # number each query's rows, so each round merges one row per query
+    order = np.argsort(query, kind="stable")
+    first = np.ones(len(query), dtype=bool)
+    first[1:] = query[order][1:] != query[order][:-1]
+    position = np.arange(len(query))
+    rank = np.empty_like(position)
+    rank[order] = position - np.maximum.accumulate(
+        np.where(first, position, 0))
+
+    # a few rounds is quickest, but a query far from any points
+    # may have thousands of rows, so then pool them in one sort instead
+    if rank.max() < 8:
+        for r in range(rank.max() + 1):
+            rows = np.flatnonzero(rank == r)
+            q = query[rows]
+
+            # current nearest come first, so they win any ties
+            pooled_distance = np.concatenate([distances[q], distance[rows]],
+                                             1)
+            pooled_index = np.concatenate([indices[q], candidate[rows]], 1)
+            nearest = np.argsort(pooled_distance, axis=1,
+                                 kind="stable")[:, :k]
+
+            distances[q] = np.take_along_axis(pooled_distance, nearest, 1)
+            indices[q] = np.take_along_axis(pooled_index, nearest, 1)
+        return
+
+    width = distance.shape[1]
+    queries = np.unique(query)
+
+    # again, current nearest come first, and sort is stable
+    pooled_query = np.concatenate([np.repeat(queries, k),
+                                   np.repeat(query, width)])
+    pooled_distance = np.concatenate([distances[queries].ravel(),
+                                      distance.ravel()])
+    pooled_index = np.concatenate([indices[queries].ravel(),
+                                   candidate.ravel()])
+    order = np.lexsort((pooled_distance, pooled_query))
+
+    # each query's k nearest are then the first k of its run
+    nearest = order[np.searchsorted(pooled_query[order], queries)[:, None]
+                    + np.arange(k)]
+    distances[queries] = pooled_distance[nearest]
+    indices[queries] = pooled_index[nearest]
+
+
+def exclude_self(indices, offset=0):
+    '''
+    Return nearest neighbour other than each point itself,
+    given indices of each point's two nearest neighbours
+    (where the first point has index `offset`).
+    '''
+
+    itself = indices[:, 0] == np.arange(offset, offset + len(indices))
+    return np.where(itself, indices[:, 1], indices[:, 0])
+
+
+def other_than_self(distances, indices, offset=0):
+    '''
+    Return (distance, index) of nearest neighbour other than each point
+    itself, given distances and indices of each point's two nearest
+    neighbours (where the first point has index `offset`).
+    '''
+
+    nearest = exclude_self(indices, offset)
+    distance = np.where(nearest == indices[:, 0],
+                        distances[:, 0], distances[:, 1])
+
+    return distance, nearest
+
+
+def nearest_in_tree(tree, points, self_join=False, offset=0):
+    '''
+    Return (chord distance, index) of nearest point in tree
+    to each of (m, 3) array of points.
+
+    For a self-join, where points are the tree's own points from
+    index `offset` on, each point's own index is excluded (but not
+    any other point at the same coordinates, which is at distance 0).
+    '''
+
+    if self_join:
+        distances, indices = tree.query_batch(points, k=2)
+        chord, nearest = other_than_self(distances, indices, offset)
+    else:
+        distances, indices = tree.query_batch(points, k=1)
+        nearest, chord = indices[:, 0], distances[:, 0]
+
+    return chord, nearest
+
+
+def distinct(lat, lng):
+    '''
+    Return (first, place) arrays: index of first point at each
+    distinct lat/lng, in order, and which of those places each point
+    is at.
+    '''
+
+    _, first, place = np.unique(np.stack([lat, lng], axis=1), axis=0,
+                                return_index=True, return_inverse=True)
+
+    # number places in order of their first points
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+
+    return first[order], rank[place.ravel()]
+
+
+def other_copy(first, place):
+    '''
+    Return index of another point at the same place as each point
+    (the first, other than itself), or -1 if there is none,
+    given `distinct()` places of the points.
+    '''
+
+    counts = np.bincount(place, minlength=len(first))
+    order = np.argsort(place, kind="stable")
+    second = np.full(len(first), -1)
+    many = counts > 1
+    second[many] = order[(np.cumsum(counts) - counts)[many] + 1]
+
+    copy = first[place]
+    itself = copy == np.arange(len(place))
+    copy[itself] = second[place[itself]]
+
+    return copy
+
+
+def rerank(tree, points, lat, lng, query_lat, query_lng, candidates=2,
+           self_join=False, first=None, batch_size=16384):
+    '''
+    Return (distance_km, index) of nearest reference point to each of
+    (m, 3) array of query points, searching compact tree of reference
+    points, but ranking by exact haversine distance in float64 from
+    query_lat/lng to the reference points' lat/lng.
+
+    The tree's distances may be out by up to its `error` (or twice
+    that between two points it holds), which is enough to misorder
+    points a few metres apart. So each query finds its nearest
+    `candidates` in the tree, and then every point no further than
+    the furthest of those plus twice the error, which must include
+    the true nearest, and it is these that are re-ranked.
+
+    Every copy of a point would then be a candidate for every query
+    near it, so given `first` (see `distinct()`), the tree holds only
+    those reference points, one at each place, and of tied copies
+    the first is given.
+
+    For a self-join, where query points are the reference points,
+    each point's own index is excluded (and one more candidate found).
+    '''
+
+    m = len(points)
+    distance_km = np.full(m, np.nan)
+    nearest = np.full(m, -1)
+    searching = np.arange(m)
+
+    # point of tree at the place of each query, to be excluded
+    own = None
+    if self_join:
+        if first is None:
+            own = np.arange(m)
+        else:
+            _, own = distinct(query_lat, query_lng)
+
+            # any other point at the same place is at distance 0
+            copy = other_copy(first, own)
+            found = copy >= 0
+            nearest[found] = copy[found]
+            distance_km[found] = 0.0
+            searching = np.flatnonzero(~found)
+
+    for lo in range(0, len(searching), batch_size):
+        block = searching[lo:lo + batch_size]
+        distances, _ = tree.query_batch(points[block],
+                                        k=candidates + self_join)
+        query, index, _ = tree.query_within(
+            points[block], distances[:, -1] + 2 * tree.error)
+        query = block[query]
+        if own is not None:
+            other = index != own[query]
+            query, index = query[other], index[other]
+        if first is not None:
+            index = first[index]
+
+        km = haversine_array(query_lng[query], query_lat[query],
+                             lng[index], lat[index])
+
+        # nearest of each query's candidates (of equally near, first)
+        order = np.lexsort((index, km, query))
+        best = np.ones(len(order), dtype=bool)
+        best[1:] = query[order][1:] != query[order][:-1]
+        best = order[best]
+        distance_km[query[best]] = km[best]
+        nearest[query[best]] = index[best]
+
+    return distance_km, nearest
+
+
+def memory_mapped(array):
+    '''Return whether array is a view of a memory-mapped file.'''
+
+    while array is not None:
+        if isinstance(array, (np.memmap, mmap.mmap)):
+            return True
+        array = getattr(array, 'base', None)
+
+    return False
+
+
+class ReferenceIndex():
+    '''
+    3-d tree over a set of reference points, built once and then
+    used to find the nearest reference point for any other points,
+    such as the nearest depot to each customer.
+
+    Besides the tree, the index keeps the reference points' float64
+    lat/lng (16 bytes per point), to find exact distances with. For a
+    compact tree these are a third or more of its memory, unless they
+    are memory-mapped from a NPY file (see `data.load()`), when they
+    are read from disk as queries need them.
+    '''
+
+    def __init__(self, reference, leafsize=16, compact=None, candidates=2):
+        '''
+        Build index of dataframe of reference points (with `lat` and
+        `lng` in decimal degrees), which are numbered in order from 0,
+        or of the points in a file (loaded by `data.load()`).
+
+        If compact (see `KDTree`), each query's candidates, found from
+        its nearest `candidates` in the tree (see `rerank()`), are
+        re-ranked with the reference points' exact lat/lng.
+        '''
+
+        if isinstance(reference, (str, os.PathLike)):
+            reference = load(reference)
+
+        self.lat, self.lng = lat_lng(reference)
+        points = cartesian(reference)
+
+        # a compact tree holds only the first point at each place
+        # (see `rerank()`), if any points are at the same place
+        self.first = None
+        if compact is not None:
+            first, _ = distinct(self.lat, self.lng)
+            if len(first) < len(points):
+                self.first, points = first, points[first]
+
+        self.tree = KDTree(points, leafsize=leafsize, compact=compact)
+        self.candidates = candidates
+
+    def __len__(self):
+        return len(self.lat)
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by tree, and by lat/lng unless memory-mapped.
+        """
+
+        return (self.tree.nbytes
+                + (0 if self.first is None else self.first.nbytes)
+                + sum(0 if memory_mapped(a) else a.nbytes
+                      for a in (self.lat, self.lng)))
+
+    def query(self, df, self_join=False, from_chord=False):
+        '''
+        Return df with `distance_km` and `neighbour_index` (position
+        in reference points) of nearest reference point to each point.
+
+        Set self_join if df is the reference points themselves, in the
+        same order, so that each point's own index is excluded.
+        With from_chord, distances are converted from the tree's chord
+        distances rather than recomputed by haversine (unless compact,
+        when candidates are always re-ranked by haversine).
+        '''
+
+        points = cartesian(df)
+        lat, lng = lat_lng(df)
+
+        if self.tree.compact is not None:
+            distance_km, nearest = rerank(self.tree, points, self.lat,
+                                          self.lng, lat, lng,
+                                          self.candidates, self_join,
+                                          self.first)
+            df['neighbour_index'] = nearest
+            df['distance_km'] = distance_km
+
+            return df
+
+        chord, nearest = nearest_in_tree(self.tree, points, self_join)
+
+        found = nearest >= 0
+        distance_km = np.full(len(df), np.nan)
+        if from_chord:
+            distance_km[found] = chord_to_km(chord[found])
+        else:
+            distance_km[found] = haversine_array(
+                lng[found], lat[found],
+                self.lng[nearest[found]], self.lat[nearest[found]])
+
+        df['neighbour_index'] = nearest
+        df['distance_km'] = distance_km
+
+        return df
+
+
+def use_reference(df, reference=None, leafsize=16, compact=None,
+                  from_chord=False):
+    '''
+    Find nearest of reference points for each point in df,
+    or (by default, or if reference is df) nearest other point
+    in df itself.
+    '''
+
+    self_join = reference is None or reference is df
+    index = ReferenceIndex(df if self_join else reference, leafsize,
+                           compact)
+
+    return index.query(df, self_join, from_chord)
+
+
+def fill_neighbours(df, nearest, chord=None):
+    '''
+    Fill in each point's `neighbour_index` and `distance_km` in df,
+    with distance converted from the chord distance between the points
+    on the unit sphere if given (one vectorized arcsin), otherwise
+    recomputed by haversine formula (as `given.slow()` computes it).
+    Points with no neighbour (index -1) get distance NaN.
+    '''
+
+    df['neighbour_index'] = nearest
+    if chord is None:
+        df['distance_km'] = neighbour_distances(df)
+    else:
+        df['distance_km'] = np.where(np.asarray(nearest) >= 0,
+                                     chord_to_km(chord), np.nan)
 
     return df
+
+
+def neighbour_distances(df):
+    '''
+    Return haversine distance between each point in df
+    and the point given by its `neighbour_index` (NaN if -1).
+    '''
+
+    lat, lng = lat_lng(df)
+    j = df.neighbour_index.to_numpy(dtype=np.intp)
+
+    return np.where(j >= 0, haversine_array(lng, lat, lng[j], lat[j]),
+                    np.nan)
+
+
+def use_3dtree(df, leafsize=16, compact=None, candidates=2,
+               from_chord=False, stats=None, order=None):
+    """
+    Use 3-dimensional k-d tree to give solution
+
+    With from_chord, distances are converted from the tree's chord
+    distances, rather than recomputed by haversine formula.
+    If compact (see `KDTree`), the tree only gives candidates for
+    each point's nearest, which are re-ranked by haversine (see
+    `rerank()`).
+    If given a `TreeStats`, the tree's work is recorded in it.
+    If order is 'morton' or 'hilbert', points are first sorted along
+    that space-filling curve (see `curve`), for locality of memory.
+    """
+
+    points = cartesian(df)
+
+    # sort points along curve, so that consecutive queries are near
+    # each other, then renumber answers back to df's order at the end
+    if order is not None:
+        perm = curve_order(points, order)
+        points = points[perm]
+
+    # a compact tree holds only the first point at each place
+    # (see `rerank()`), if any points are at the same place
+    first = None
+    if compact is not None:
+        lat, lng = lat_lng(df)
+        if order is not None:
+            lat, lng = lat[perm], lng[perm]
+        first, _ = distinct(lat, lng)
+        if len(first) == len(points):
+            first = None
+
+    # construct kd-tree from x-y-z coordinates
+    tree = KDTree(points if first is None else points[first],
+                  leafsize=leafsize, compact=compact, stats=stats)
+
+    # then use to find nearest neighbours for all points at once
+    if compact is not None:
+        distance_km, nearest = rerank(tree, points, lat, lng, lat, lng,
+                                      candidates, self_join=True,
+                                      first=first)
+        chord = None
+    else:
+        chord, nearest = nearest_in_tree(tree, points, self_join=True)
+        distance_km = None
+
+    if order is not None:
+        # renumber only points found, keeping -1 for none
+        found = nearest >= 0
+        nearest = nearest.copy()
+        nearest[found] = perm[nearest[found]]
+        nearest = unpermute(nearest, perm)
+        chord = None if chord is None else unpermute(chord, perm)
+        if distance_km is not None:
+            distance_km = unpermute(distance_km, perm)
+
+    if distance_km is not None:
+        df['distance_km'], df['neighbour_index'] = distance_km, nearest
+        return df
+
+    # then find spherical distance, from chord or by haversine formula
+    return fill_neighbours(df, nearest, chord if from_chord else None)
+
+
+def unpermute(values, perm):
+    '''
+    Return values for points taken in order perm,
+    put back in points' original order.
+    '''
+
+    original = np.empty_like(values)
+    original[perm] = values
+
+    return original
+
+
+# TASK.md accepts answers within 0.1% of `given.slow()`
+TOLERANCE = 0.001
+
+
+def use_approximate(df, eps=TOLERANCE, max_leaves=None, leafsize=16,
+                    from_chord=False):
+    """
+    Use 3-dimensional k-d tree to give approximate solution,
+    where each neighbour found is no more than about (1 + eps) times
+    further away than the nearest (see `KDTree.query_batch()`),
+    or is the nearest of the first `max_leaves` leaves searched.
+
+    With from_chord, distances are converted from the tree's chord
+    distances, rather than recomputed by haversine formula.
+    """
+
+    points = cartesian(df)
+
+    # construct kd-tree from x-y-z coordinates
+    tree = KDTree(points, leafsize=leafsize)
+
+    # then find (approximately) nearest neighbours of all points at once
+    distances, indices = tree.query_batch(points, k=2, eps=eps,
+                                          max_leaves=max_leaves)
+    chord, nearest = other_than_self(distances, indices)
+
+    # then find spherical distance, from chord or by haversine formula
+    return fill_neighbours(df, nearest, chord if from_chord else None)
+
+
+def approximation_error(df, exact, tolerance=TOLERANCE):
+    '''
+    Compare approximate solution df with exact solution (from
+    `given.slow()`, or any exact solver), returning recall (fraction
+    of points given their true nearest neighbour), mean and maximum
+    relative error in distance, and fraction of distances within
+    relative tolerance.
+    '''
+
+    found = df.distance_km.to_numpy(dtype=np.float64)
+    true = exact.distance_km.to_numpy(dtype=np.float64)
+
+    # identical points are at distance 0, so only exact answer will do
+    with np.errstate(divide='ignore', invalid='ignore'):
+        error = np.where(found == true, 0.0, (found - true) / true)
+
+    recall = (df.neighbour_index.to_numpy()
+              == exact.neighbour_index.to_numpy()).mean()
+
+    return {'recall': float(recall) if len(df) else 1.0,
+            'mean_error': float(error.mean()) if len(df) else 0.0,
+            'max_error': float(error.max()) if len(df) else 0.0,
+            'within_tolerance': (float((error <= tolerance).mean())
+                                 if len(df) else 1.0)}
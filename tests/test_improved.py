@@ -2,12 +2,18 @@
 PyTest tests for attempted improvements.
 """
 
+import numpy as np
+import pandas as pd
+
 from opt_nn import given, improved, kdtree, xyz
 
 
-def check_solution(alternative_solution):
+def check_solution(alternative_solution, rtol=1e-12):
     '''
     Check that improved solution returns same values as given slow solution.
+
+    Distances need only agree to within relative tolerance `rtol`,
+    since vectorized sin and cos may differ from `math` in the last bit.
     '''
 
     df = given.make_data(100)
@@ -17,7 +23,10 @@ def check_solution(alternative_solution):
     a1 = alternative_solution(df.copy())
 
     # compare equality of distances
-    compare_distance = (a1.distance_km == a0.distance_km)
+    compare_distance = np.isclose(a1.distance_km.astype(float),
+                                  a0.distance_km.astype(float),
+                                  rtol=rtol, atol=0)
+    compare_distance = pd.Series(compare_distance)
     # compare equality of neighbour indices
     compare_index = (a1.neighbour_index == a0.neighbour_index)
 
@@ -71,6 +80,57 @@ def test_use_kdtree():
     check_solution(kdtree.use_kdtree)
 
 
+def test_kdtree_save_load(tmp_path):
+    '''
+    Test lat/lng tree keeps each node's region through save and load,
+    and that its search still agrees with `given.slow()`.
+    '''
+
+    df = given.make_data(200)
+    a0 = given.slow(df.copy())
+
+    tree = kdtree.build_kdtree(df, leafsize=4)
+    assert tree.region.shape == (len(tree.left), 4)
+    assert tuple(tree.region[0]) == kdtree.WORLD
+
+    tree.save(tmp_path / 'tree.bin')
+    loaded = kdtree.LatLngTree.load(tmp_path / 'tree.bin')
+    assert (loaded.region == tree.region).all()
+
+    for i in range(0, 200, 20):
+        distance, j = kdtree.kdtree_closest_point(loaded, i)
+        assert j == a0.neighbour_index[i]
+        assert np.isclose(distance, a0.distance_km[i], rtol=1e-12, atol=0)
+
+
+def test_use_kdtree_wrapping():
+    '''
+    Test `kdtree.use_kdtree()` solution for points either side
+    of the antimeridian and around the north pole, and for
+    longitudes given in [0, 360) rather than [-180, 180).
+    '''
+
+    df = given.make_data(60)
+    df['lng'] = (df.lng % 4) + 178
+    df.loc[df.lng > 180, 'lng'] -= 360
+    df.loc[:29, 'lat'] = 90 - (df.lat[:30] % 3)
+
+    a0 = given.slow(df.copy())
+    a1 = kdtree.use_kdtree(df.copy(), leafsize=1)
+
+    assert (a1.neighbour_index == a0.neighbour_index).all()
+    assert np.allclose(a1.distance_km, a0.distance_km.astype(float),
+                       rtol=1e-12, atol=0)
+
+    df = given.make_data(300)
+    a0 = kdtree.use_kdtree(df.copy())
+    df['lng'] = df.lng % 360
+    a1 = kdtree.use_kdtree(df.copy())
+
+    assert (a1.neighbour_index == a0.neighbour_index).all()
+    assert np.allclose(a1.distance_km, a0.distance_km, rtol=1e-12, atol=0)
+
+
 def test_use_3dtree():
     '''
     Test `xyz.use_3dtree()` solution.
@@ -78,6 +138,15 @@ def test_use_3dtree():
 
     check_solution(xyz.use_3dtree)
 
+def test_use_grid():
+    '''
+    Test `grid.use_grid()` solution.
+    '''
+
+    from opt_nn import grid
+
+    check_solution(grid.use_grid)
+
 def test_transform_coords():
     '''
     Test that nearest neighbours are the same
@@ -116,3 +185,961 @@ def test_h_distance():
     assert improved.h_distance(p0, p1) == given.haversine(
         p0.lng, p0.lat, p1.lng, p1.lat
     )
+
+def test_3dtree_knn():
+    '''
+    Test that array-backed `xyz.KDTree.knn()` agrees with brute force.
+    '''
+
+    from opt_nn.xyz import KDTree, transform_coords
+
+    df = transform_coords(given.make_data(200))
+    points = df[['x', 'y', 'z']].to_numpy()
+    tree = KDTree(points)
+
+    for i in range(0, 200, 20):
+        sq_distances = ((points - points[i]) ** 2).sum(axis=1)
+        distances, indices = tree.knn(points[i], k=3)
+
+        assert list(indices) == list(sq_distances.argsort()[:3])
+        assert max(abs(distances ** 2 - sorted(sq_distances)[:3])) < 1e-12
+
+    # asking for more neighbours than there are points pads with -1
+    distances, indices = KDTree(points[:4]).knn(points[0], k=6)
+    assert list(indices[4:]) == [-1, -1]
+    assert np.isinf(distances[4:]).all()
+
+    # asking for no neighbours at all is refused
+    for query in (lambda: tree.knn(points[0], k=0),
+                  lambda: tree.query_batch(points, k=0)):
+        try:
+            query()
+        except ValueError:
+            pass
+        else:
+            assert False, 'k < 1 should be refused'
+
+def test_3dtree_query_batch():
+    '''
+    Test that `xyz.KDTree.query_batch()` agrees with single `knn()` queries.
+    '''
+
+    from opt_nn.xyz import KDTree, transform_coords
+
+    points = transform_coords(given.make_data(200))[['x', 'y', 'z']]
+    queries = transform_coords(given.make_data(50))[['x', 'y', 'z']]
+    tree = KDTree(points.to_numpy())
+
+    distances, indices = tree.query_batch(queries.to_numpy(), k=3)
+
+    assert distances.shape == indices.shape == (50, 3)
+    for i, query in enumerate(queries.to_numpy()):
+        d, j = tree.knn(query, k=3)
+        assert list(indices[i]) == list(j)
+        assert max(abs(distances[i] - d)) < 1e-12
+
+def test_use_3dtree_leafsize():
+    '''
+    Test `xyz.use_3dtree()` solution with leaves of different sizes.
+    '''
+
+    for leafsize in (1, 5, 200):
+        check_solution(lambda df: xyz.use_3dtree(df, leafsize=leafsize))
+
+def test_parallel_nearest_neighbours():
+    '''
+    Test `parallel.nearest_neighbours()` solution,
+    and that it agrees exactly with `xyz.use_3dtree()`.
+    '''
+
+    from opt_nn import parallel
+
+    check_solution(lambda df: parallel.nearest_neighbours(df, workers=2))
+
+    df = given.make_data(5000)
+    a0 = xyz.use_3dtree(df.copy())
+    a1 = parallel.nearest_neighbours(df.copy(), workers=3)
+
+    assert (a1.neighbour_index == a0.neighbour_index).all()
+    assert (a1.distance_km == a0.distance_km).all()
+
+def test_parallel_build():
+    '''
+    Test tree built by several processes is byte-identical
+    to tree built by one, and is held in the shared arrays
+    which query workers are given.
+    '''
+
+    from opt_nn import data
+    from opt_nn.parallel import view
+
+    points = xyz.cartesian(data.generate(20000, seed=0))
+
+    for n, leafsize, compact in ((20000, 16, None), (20000, 1, 'int32'),
+                                 (20000, 5, 'float32'), (10, 16, None)):
+        serial = xyz.KDTree(points[:n], leafsize, compact)
+        parallel = xyz.KDTree(points[:n], leafsize, compact, workers=3)
+        for name in xyz.KDTree.arrays:
+            a, b = getattr(serial, name), getattr(parallel, name)
+            assert a.dtype == b.dtype
+            assert a.tobytes() == b.tobytes()
+            assert np.shares_memory(b, view(parallel.shared[name]))
+
+
+def test_3dtree_save_load(tmp_path):
+    '''
+    Test that `xyz.KDTree` gives same answers after saving and loading,
+    whether or not it is memory-mapped.
+    '''
+
+    from opt_nn.xyz import KDTree
+
+    points = xyz.transform_coords(given.make_data(500))[['x', 'y', 'z']]
+    points = points.to_numpy()
+    tree = KDTree(points, leafsize=8)
+    expected = tree.query_batch(points, k=2)
+
+    path = tmp_path / 'tree.kdt'
+    tree.save(path)
+
+    for mmap in (True, False):
+        loaded = KDTree.load(path, mmap=mmap)
+        assert loaded.leafsize == 8
+        for name in KDTree.arrays:
+            assert (getattr(loaded, name) == getattr(tree, name)).all()
+        distances, indices = loaded.query_batch(points, k=2)
+        assert (indices == expected[1]).all()
+        assert (distances == expected[0]).all()
+
+def test_incremental_index():
+    '''
+    Test that `incremental.IncrementalIndex` keeps nearest neighbours
+    the same as `xyz.use_3dtree()` after points are inserted and removed.
+    '''
+
+    from opt_nn.incremental import IncrementalIndex
+
+    df = given.make_data(1000)
+    index = IncrementalIndex(df[:800])
+    assert len(index.update_neighbours()) == 800
+
+    index.insert(df[800:])
+    index.remove(range(0, 1000, 10))
+    changed = index.update_neighbours()
+    assert 200 <= len(changed) < 900
+
+    alive = [i for i in range(1000) if i % 10]
+    a0 = xyz.use_3dtree(df.iloc[alive].reset_index(drop=True))
+
+    assert (index.neighbour_index[alive] == a0.neighbour_index.map(
+        lambda i: alive[i])).all()
+    assert max(abs(index.distance_km[alive] - a0.distance_km)) < 1e-6
+
+
+def test_incremental_index_updates():
+    '''
+    Test that points without a neighbour are solved once there are
+    others, and that one remote point doesn't make every update
+    search the whole index.
+    '''
+
+    from opt_nn import data
+    from opt_nn.incremental import IncrementalIndex
+
+    index = IncrementalIndex(data.generate(1, seed=0))
+    index.update_neighbours()
+    assert index.neighbour_index[0] == -1
+    assert np.isnan(index.distance_km[0])
+
+    index.insert(data.generate(3, seed=1))
+    index.update_neighbours()
+    a0 = xyz.use_3dtree(data.frame(*data.lat_lng(
+        pd.concat([data.generate(1, seed=0), data.generate(3, seed=1)]))))
+    assert (index.neighbour_index[:4] == a0.neighbour_index).all()
+    assert np.allclose(index.distance_km, a0.distance_km)
+
+    df = data.clustered(20000, spread=0.1, seed=0)
+    df.loc[0, ['lat', 'lng']] = (0.0, 0.0)
+    index = IncrementalIndex(df)
+    index.update_neighbours()
+
+    # insert points among the others, which need only search near them
+    near = df[1:101]
+    index.insert(data.frame(near.lat + 0.01, near.lng + 0.01))
+    tree = index.trees[0][2]
+    tree.stats = xyz.TreeStats()
+    index.update_neighbours()
+    assert tree.stats.distances < len(tree)
+
+    points = index.data[:index.n]
+    distances, indices = xyz.KDTree(points).query_batch(points, k=2)
+    assert (index.neighbour_index[:index.n]
+            == xyz.exclude_self(indices)).all()
+
+
+def test_stream_nearest(tmp_path):
+    '''
+    Test `stream.stream_nearest()` in chunks agrees with
+    `xyz.use_3dtree()` for self-join, and with brute force
+    for separate query and reference files.
+    '''
+
+    import pandas as pd
+
+    from opt_nn import stream
+
+    df = given.make_data(1000)
+    df[['lat', 'lng']].to_csv(tmp_path / 'points.csv', index=False)
+    df[:300][['lat', 'lng']].to_csv(tmp_path / 'queries.csv', index=False)
+    df[300:][['lat', 'lng']].to_csv(tmp_path / 'reference.csv', index=False)
+
+    rows = stream.stream_nearest(tmp_path / 'points.csv',
+                                 tmp_path / 'out.csv', chunksize=128)
+    assert rows == 1000
+
+    a0 = xyz.use_3dtree(df.copy())
+    a1 = pd.read_csv(tmp_path / 'out.csv')
+    assert (a1.neighbour_index == a0.neighbour_index).all()
+    assert max(abs(a1.distance_km / a0.distance_km - 1)) < 1e-9
+
+    stream.stream_nearest(tmp_path / 'queries.csv', tmp_path / 'cross.csv',
+                          reference_path=tmp_path / 'reference.csv',
+                          chunksize=128)
+    a2 = pd.read_csv(tmp_path / 'cross.csv')
+
+    xyz_all = xyz.transform_coords(df)[['x', 'y', 'z']].to_numpy()
+    for i in range(0, 300, 30):
+        sq_distances = ((xyz_all[300:] - xyz_all[i]) ** 2).sum(axis=1)
+        assert a2.neighbour_index[i] == sq_distances.argmin()
+
+
+def test_benchmark(tmp_path):
+    '''
+    Check benchmark gives a record for each solution, size and phase,
+    skips sizes over budget, and saves JSON and CSV results, and that
+    every engine's query phase gives the same solution.
+    '''
+
+    import json
+
+    from opt_nn import profile
+
+    solutions = {'slow': given.slow,
+                 'use_3dtree': profile.PHASES['use_3dtree']}
+    records = profile.benchmark(solutions, sizes=(10, 20, 10**6),
+                                repeats=2, budget=1.0)
+
+    assert [(r['solution'], r['n'], r['phase']) for r in records] == [
+        ('slow', 10, 'solve'), ('slow', 20, 'solve'),
+        ('use_3dtree', 10, 'build'), ('use_3dtree', 10, 'query'),
+        ('use_3dtree', 20, 'build'), ('use_3dtree', 20, 'query')]
+    assert all(r['repeats'] == 2 and r['peak_mb'] > 0 for r in records)
+
+    json_path, csv_path = profile.save_benchmark(records, tmp_path)
+    with open(json_path) as f:
+        assert json.load(f)['records'] == records
+    assert len(open(csv_path).readlines()) == len(records) + 1
+    assert profile.compare_benchmarks(json_path, json_path).empty
+
+    # every query phase gives the same, whole solution
+    df = given.make_data(100)
+    a0 = given.slow(df.copy())
+    for phases in profile.PHASES.values():
+        a = phases['query'](phases['build'](df.copy()), df.copy())
+        assert (a.neighbour_index == a0.neighbour_index).all()
+        assert np.allclose(a.distance_km, a0.distance_km.astype(float),
+                           rtol=1e-12, atol=0)
+
+
+def test_haversine_array():
+    '''
+    Test that vectorized haversine agrees with `given.haversine()`,
+    and broadcasts one point against many.
+    '''
+
+    df = given.make_data(1000)
+    lat, lng = df.lat.to_numpy(), df.lng.to_numpy()
+
+    d0 = np.array([given.haversine(lng[0], lat[0], lng[i], lat[i])
+                   for i in range(1000)])
+    d1 = improved.haversine_array(lng[0], lat[0], lng, lat)
+
+    assert d1.shape == (1000,)
+    assert np.allclose(d1, d0, rtol=1e-12, atol=1e-9)
+
+    d2 = improved.haversine_array(lng[:, None], lat[:, None], lng, lat)
+    assert d2.shape == (1000, 1000)
+    assert np.allclose(d2[0], d1, rtol=1e-12, atol=1e-9)
+
+
+def test_use_blocks():
+    '''
+    Test `improved.use_blocks()` solution, with blocks small enough
+    that the points are split across several.
+    '''
+
+    check_solution(improved.use_blocks)
+    check_solution(lambda df: improved.use_blocks(df, block_size=7))
+
+    # points in a box a couple of metres across, closer than
+    # a matrix product of dot products can tell apart
+    from opt_nn import data
+
+    rng = np.random.default_rng(0)
+    df = data.frame(51.5 + rng.random(2000) * 1.8e-5,
+                    -0.1 + rng.random(2000) * 2.9e-5)
+    a = improved.use_blocks(df.copy())
+    b = xyz.use_3dtree(df.copy())
+    assert (a.neighbour_index == b.neighbour_index).all()
+    assert (a.distance_km == b.distance_km).all()
+
+
+def test_distances():
+    '''
+    Test `improved.Distances` finds same nearest neighbours as slow,
+    whether all points are in one block or split across several.
+    '''
+
+    df = given.make_data(100)
+    a0 = given.slow(df.copy())
+
+    for block_size in (7, 100, 256):
+        a1 = improved.Distances(df, block_size=block_size).find_nn()
+
+        assert (a1.neighbour_index == a0.neighbour_index).all()
+        assert np.allclose(a1.distance_km, a0.distance_km.astype(float),
+                           rtol=1e-12, atol=0)
+
+
+def test_distance_cache():
+    '''
+    Test that points have no per-point memo, and that shared
+    distance cache is bounded, symmetric, and counts hits and misses.
+    '''
+
+    points = xyz.make_point_list(given.make_data(10))
+    assert not hasattr(points[0], '__dict__')
+    assert points[0].dist(points[1]) == xyz.euclidean(points[0], points[1])
+
+    cache = xyz.DistanceCache(maxsize=3)
+    xyz.CartesianPoint.cache = cache
+    try:
+        d = points[0].dist(points[1])
+        assert points[1].dist(points[0]) == d
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        for p in points[2:]:
+            points[0].dist(p)
+        assert len(cache) == 3
+        assert cache.misses == 9
+
+        # points of another dataframe share names, but not distances
+        others = xyz.make_point_list(given.make_data(10))
+        assert others[0].dist(others[1]) == xyz.euclidean(others[0],
+                                                          others[1])
+        assert cache.misses == 10
+    finally:
+        xyz.CartesianPoint.cache = None
+
+
+def duplicated_data(duplicates=20000, others=1000):
+    '''
+    Make dataframe of many points at the same place,
+    shuffled among some random points.
+    '''
+
+    from opt_nn import data
+
+    df = data.generate(duplicates + others, seed=0)
+    df.loc[:duplicates - 1, ['lat', 'lng']] = (51.5, -0.1)
+
+    return df.sample(frac=1, random_state=0).reset_index(drop=True)
+
+
+def test_3dtree_duplicates():
+    '''
+    Test tree search stays quick with many identical points,
+    each of whose nearest neighbour is another at distance 0.
+    '''
+
+    df = duplicated_data()
+    same = (df.lat == 51.5) & (df.lng == -0.1)
+
+    a = xyz.use_3dtree(df.copy())
+    assert (a.distance_km[same] == 0).all()
+    assert (a.neighbour_index[same] != np.flatnonzero(same)).all()
+    assert same[a.neighbour_index[same]].all()
+
+    # radius search must still include points right on its boundary
+    tree = xyz.KDTree(df)
+    query, index, distance = tree.query_within(tree.data[:1], 0.0)
+    assert len(index) == (same.sum() if same[0] else 1)
+
+
+def test_grid_crowded_cells():
+    '''
+    Test grid agrees with tree where points crowd into a few cells,
+    which are then subdivided rather than searched pairwise.
+    '''
+
+    from opt_nn import data, grid
+
+    for df in (data.clustered(10000, clusters=3, spread=0.05, seed=0),
+               duplicated_data()):
+        g = grid.Grid(xyz.cartesian(df))
+        assert g.subtrees
+
+        a = grid.use_grid(df.copy())
+        b = xyz.use_3dtree(df.copy())
+        assert np.allclose(a.distance_km, b.distance_km,
+                           rtol=1e-12, atol=1e-12)
+        assert (a.neighbour_index != np.arange(len(df))).all()
+
+
+
+def test_grid_outlier():
+    '''
+    Test grid agrees with `given.slow()` on clustered points
+    with one outlier on the far side of the globe, whose search
+    outgrows max_ring and is finished by a tree.
+    '''
+
+    from opt_nn import data, grid
+
+    cluster = data.clustered(200, clusters=1, spread=0.5, seed=0)
+    lat = np.append(cluster.lat, -cluster.lat[0])
+    lng = np.append(cluster.lng, (cluster.lng[0] + 360) % 360 - 180)
+
+    df = given.make_data(len(lat))
+    df['lat'], df['lng'] = lat, lng
+    a0 = given.slow(df.copy())
+
+    points = xyz.cartesian(df)
+    for max_ring in (0, 8):
+        g = grid.Grid(points, max_ring=max_ring)
+        chord, nearest = xyz.nearest_in_tree(g, points, self_join=True)
+        a1 = xyz.fill_neighbours(df.copy(), nearest)
+
+        assert (a1.neighbour_index == a0.neighbour_index).all()
+        assert np.allclose(a1.distance_km, a0.distance_km.astype(float),
+                           rtol=1e-12, atol=0)
+        assert (g._tree is not None) == (max_ring == 0)
+
+
+def test_3dtree_query_radius():
+    '''
+    Test that `xyz.KDTree.query_radius()` finds every point within
+    a great-circle radius (in km), agreeing with haversine.
+    '''
+
+    df = xyz.transform_coords(given.make_data(2000))
+    tree = xyz.KDTree(df)
+    lat, lng = df.lat.to_numpy(), df.lng.to_numpy()
+    points = df[['x', 'y', 'z']].to_numpy()
+
+    query, index, distance_km = tree.query_radius(points[:50], 500)
+
+    for i in range(50):
+        km = improved.haversine_array(lng[i], lat[i], lng, lat)
+        within = np.flatnonzero(km <= 500)
+        found = index[query == i]
+
+        assert sorted(found) == sorted(within)
+        assert list(found) == list(within[np.argsort(km[within],
+                                                     kind='stable')])
+        assert np.allclose(distance_km[query == i], km[found],
+                           rtol=1e-9, atol=1e-9)
+
+
+def test_reference_index(tmp_path):
+    '''
+    Test nearest of a separate set of reference points, and that self
+    is excluded only for a self-join, but exact duplicates are not,
+    and that the index's memory counts lat/lng unless memory-mapped.
+    '''
+
+    df = given.make_data(500)
+    queries, reference = df[:100].copy(), df[100:].reset_index(drop=True)
+
+    a1 = xyz.use_reference(queries.copy(), reference)
+    for i in range(0, 100, 10):
+        km = improved.haversine_array(queries.lng[i], queries.lat[i],
+                                      reference.lng, reference.lat)
+        assert a1.neighbour_index[i] == km.argmin()
+        assert np.isclose(a1.distance_km[i], km.min(), rtol=1e-12)
+
+    # a reference point is its own nearest unless it is a self-join
+    index = xyz.ReferenceIndex(reference)
+    a2 = index.query(reference[:10].copy())
+    assert (a2.neighbour_index == np.arange(10)).all()
+    assert (a2.distance_km == 0).all()
+
+    for compact in (None, 'float32'):
+        index = xyz.ReferenceIndex(reference, compact=compact)
+        assert index.nbytes == index.tree.nbytes + 16 * len(reference)
+
+        path = tmp_path / 'reference.npy'
+        np.save(path, reference[['lat', 'lng']].to_numpy())
+        mapped = xyz.ReferenceIndex(path, compact=compact)
+        assert mapped.nbytes == mapped.tree.nbytes
+        a4 = mapped.query(queries.copy())
+        a5 = index.query(queries.copy())
+        assert (a4.neighbour_index == a5.neighbour_index).all()
+        assert (a4.distance_km == a5.distance_km).all()
+
+    check_solution(xyz.use_reference)
+    check_solution(lambda df: xyz.use_reference(df, df))
+
+    # with every point duplicated, each point's nearest is its twin
+    twins = pd.concat([reference[:50], reference[:50]], ignore_index=True)
+    a3 = xyz.use_reference(twins.copy())
+    assert (a3.neighbour_index == (np.arange(100) + 50) % 100).all()
+    assert (a3.distance_km == 0).all()
+
+
+def test_use_dualtree():
+    '''
+    Test `dualtree.use_dualtree()` solution, including with leaves
+    of different sizes, and that it agrees with `use_3dtree()`.
+    '''
+
+    from opt_nn import dualtree
+
+    check_solution(dualtree.use_dualtree)
+    for leafsize in (1, 5, 200):
+        check_solution(lambda df: dualtree.use_dualtree(df, leafsize))
+
+    df = given.make_data(5000)
+    a0 = xyz.use_3dtree(df.copy())
+    a1 = dualtree.use_dualtree(df.copy())
+    assert (a1.neighbour_index == a0.neighbour_index).all()
+
+    # many identical points, any of which is as near as another
+    df = duplicated_data()
+    same = ((df.lat == 51.5) & (df.lng == -0.1)).to_numpy()
+    a0 = xyz.use_3dtree(df.copy())
+    a1 = dualtree.use_dualtree(df.copy())
+    assert (a1.distance_km == a0.distance_km).all()
+    tied = same[a0.neighbour_index]
+    assert (a1.neighbour_index[~tied] == a0.neighbour_index[~tied]).all()
+    assert same[a1.neighbour_index[tied]].all()
+    assert (a1.neighbour_index != np.arange(len(df))).all()
+
+
+def test_3dtree_compact():
+    '''
+    Test compact (float32 and quantized int32) trees take less memory,
+    but still give same solution once candidates are re-ranked.
+    '''
+
+    df = xyz.transform_coords(given.make_data(1000))
+    full = xyz.KDTree(df)
+
+    for compact in ('float32', 'int32'):
+        tree = xyz.KDTree(df, compact=compact)
+        assert tree.compact == compact
+        assert tree.nbytes < 0.6 * full.nbytes
+        assert np.abs(tree.coords() - full.data).max() < 1e-7
+
+        check_solution(lambda df: xyz.use_3dtree(df, compact=compact))
+        check_solution(lambda df: xyz.use_reference(df, compact=compact))
+
+    # points in a box a couple of metres across, closer together than
+    # compact coordinates can tell apart, so that candidates must be
+    # gathered from within the error of compact distances
+    from opt_nn import data
+
+    rng = np.random.default_rng(0)
+    df = data.frame(51.5 + rng.random(2000) * 1.8e-5,
+                    -0.1 + rng.random(2000) * 2.9e-5)
+    a0 = improved.use_blocks(df.copy())
+    for compact in ('float32', 'int32'):
+        a1 = xyz.use_3dtree(df.copy(), compact=compact)
+        a2 = xyz.use_reference(df.copy(), compact=compact)
+        for a in (a1, a2):
+            assert (a.neighbour_index == a0.neighbour_index).all()
+            assert (a.distance_km == a0.distance_km).all()
+
+    # many identical points, each of whose nearest is another copy
+    # (and which must not all be candidates for each other)
+    df = duplicated_data()
+    same = ((df.lat == 51.5) & (df.lng == -0.1)).to_numpy()
+    a0 = xyz.use_3dtree(df.copy())
+    for compact in ('float32', 'int32'):
+        a1 = xyz.use_3dtree(df.copy(), compact=compact)
+        a2 = xyz.use_reference(df.copy(), compact=compact)
+        a3 = xyz.use_reference(df[~same].copy(), df, compact=compact)
+        tied = same[a0.neighbour_index]
+        for a in (a1, a2):
+            assert (a.distance_km == a0.distance_km).all()
+            assert (a.neighbour_index[~tied]
+                    == a0.neighbour_index[~tied]).all()
+            assert same[a.neighbour_index[tied]].all()
+            assert (a.neighbour_index != np.arange(len(df))).all()
+        assert (a3.neighbour_index == np.flatnonzero(~same)).all()
+
+    try:
+        xyz.KDTree(df, compact='float16')
+    except ValueError:
+        pass
+    else:
+        assert False, 'unknown compact mode should be refused'
+
+
+def test_from_chord():
+    '''
+    Test every solution finding distances from chord distances,
+    which must agree with `given.haversine()` to within tolerance.
+    '''
+
+    from opt_nn import dualtree, grid, parallel
+
+    solutions = [
+        lambda df: improved.use_blocks(df, from_chord=True),
+        lambda df: xyz.use_3dtree(df, from_chord=True),
+        lambda df: xyz.use_approximate(df, from_chord=True),
+        lambda df: xyz.use_reference(df, from_chord=True),
+        lambda df: grid.use_grid(df, from_chord=True),
+        lambda df: dualtree.use_dualtree(df, from_chord=True),
+        lambda df: parallel.nearest_neighbours(df, workers=2,
+                                               from_chord=True),
+    ]
+
+    df = given.make_data(500)
+    for solution in solutions:
+        check_solution(solution, rtol=1e-9)
+
+        a = solution(df.copy())
+        expected = [given.haversine(df.lng[i], df.lat[i],
+                                    df.lng[j], df.lat[j])
+                    for i, j in enumerate(a.neighbour_index)]
+        assert np.allclose(a.distance_km, expected, rtol=1e-9, atol=0)
+
+
+def test_lone_point():
+    '''
+    Test every solution gives a lone point no neighbour (-1)
+    and distance NaN, as `data.frame()` starts unsolved points.
+    '''
+
+    from opt_nn import data, dualtree, grid, parallel, stream
+
+    solutions = [
+        improved.less_slow,
+        lambda df: improved.Distances(df).find_nn(),
+        kdtree.use_kdtree,
+        lambda df: xyz.use_3dtree(df, compact='float32'),
+        xyz.use_approximate,
+        lambda df: next(stream.solve_chunks([df], xyz.KDTree(df),
+                                            self_join=True)),
+    ]
+    for solve in (improved.use_blocks, xyz.use_3dtree, grid.use_grid,
+                  dualtree.use_dualtree, parallel.nearest_neighbours):
+        for from_chord in (False, True):
+            solutions.append(lambda df, solve=solve, from_chord=from_chord:
+                             solve(df, from_chord=from_chord))
+
+    df = data.generate(1, seed=0)
+    for solution in solutions:
+        a = solution(df.copy())
+        assert (a.neighbour_index == -1).all()
+        assert a.distance_km.isna().all()
+
+
+def test_data(tmp_path):
+    '''
+    Test typed dataframes can be generated (reproducibly) and loaded,
+    and solved without copying or changing their dtypes.
+    '''
+
+    from opt_nn import data
+
+    df = data.generate(1000, seed=1)
+    assert df.equals(data.generate(1000, seed=1))
+    assert df.dtypes.to_dict() == {'lat': np.float64, 'lng': np.float64,
+                                   'distance_km': np.float64,
+                                   'neighbour_index': np.int64}
+    assert df.distance_km.isna().all()
+    assert (df.neighbour_index == -1).all()
+
+    # lat/lng are read without copying, even by transform_coords()
+    lat, lng = data.lat_lng(df)
+    assert np.shares_memory(lat, df.lat.to_numpy())
+    assert np.shares_memory(xyz.transform_coords(df).lat.to_numpy(), lat)
+
+    df[['lat', 'lng']].to_csv(tmp_path / 'points.csv', index=False)
+    np.save(tmp_path / 'points.npy', np.column_stack([lat, lng]))
+    for name in ('points.csv', 'points.npy'):
+        loaded = data.load(tmp_path / name)
+        assert np.allclose(loaded.lat, df.lat, rtol=1e-15, atol=0)
+        assert np.allclose(loaded.lng, df.lng, rtol=1e-15, atol=0)
+
+    solved = xyz.use_3dtree(df)
+    assert solved.neighbour_index.dtype == np.int64
+    assert solved.distance_km.dtype == np.float64
+    assert (solved.neighbour_index >= 0).all()
+
+    # given.make_data() frames can be typed too
+    df = data.typed(given.make_data(10))
+    assert df.neighbour_index.dtype == np.int64
+    check_solution(lambda df: xyz.use_3dtree(data.typed(df)))
+
+
+def test_tree_stats():
+    '''
+    Test trees record work done only when given `xyz.TreeStats`,
+    without changing their answers.
+    '''
+
+    from opt_nn import data
+
+    df = data.generate(2000, seed=0)
+    points = xyz.cartesian(df)
+
+    stats = xyz.TreeStats()
+    tree = xyz.KDTree(points, leafsize=8, stats=stats)
+    leaves = (tree.left < 0).sum()
+    assert stats.depths.sum() == leaves
+    assert len(stats.build_seconds) == len(stats.depths) - 1
+    assert stats.summary()['depth_max'] == len(stats.depths) - 1
+
+    plain = xyz.KDTree(points, leafsize=8)
+    assert plain.stats is None
+    distances, indices = tree.query_batch(points, k=2)
+    assert (indices == plain.query_batch(points, k=2)[1]).all()
+    assert stats.queries == len(points)
+    assert stats.distances >= 2 * len(points)
+    assert 0 < stats.prune_rate < 1
+
+    tree.knn(points[0], k=2)
+    assert stats.queries == len(points) + 1
+
+    stats = xyz.TreeStats()
+    check_solution(lambda df: kdtree.use_kdtree(df, stats=stats))
+    summary = stats.summary()
+    assert summary['queries'] == 100
+    assert summary['visits_mean'] >= summary['depth_min'] + 1
+    assert summary['distances_per_query'] >= 1
+
+
+def test_approximate():
+    '''
+    Test approximate search finds neighbours within its error bound,
+    and is measured correctly against exact solution.
+    '''
+
+    from opt_nn import data
+
+    # default accuracy is within TASK.md's tolerance of given.slow()
+    df = given.make_data(100)
+    exact = given.slow(df.copy())
+    error = xyz.approximation_error(xyz.use_approximate(df.copy()), exact)
+    assert error['within_tolerance'] == 1
+    assert xyz.approximation_error(exact, exact)['recall'] == 1
+
+    points = xyz.cartesian(data.generate(5000, seed=0))
+    tree = xyz.KDTree(points)
+    distances, indices = tree.query_batch(points, k=3)
+
+    for eps in (0.5, 2):
+        found, _ = tree.query_batch(points, k=3, eps=eps)
+        assert (found >= distances).all()
+        assert (found <= (1 + eps) * distances + 1e-15).all()
+
+    # searching fewer leaves does less work, and misses more
+    misses = []
+    for max_leaves in (0, 2, 1000):
+        tree.stats = xyz.TreeStats()
+        found, _ = tree.query_batch(points, k=3, max_leaves=max_leaves)
+        assert tree.stats.distances <= 16 * (len(points) * 1
+                                             + max_leaves * len(points))
+        misses.append((found > distances).sum())
+    assert misses[0] > misses[1] > misses[2] == 0
+
+
+def test_curve_order():
+    '''
+    Test points are ordered along space-filling curves,
+    and that solving in that order gives the same solution.
+    '''
+
+    from opt_nn import curve
+
+    # centres of each cell of 8x8x8 grid
+    bits = 3
+    cells = np.stack(np.meshgrid(*[np.arange(2**bits)] * 3, indexing='ij'),
+                     axis=-1).reshape(-1, 3)
+    points = (cells + 0.5) / 2**bits * 2 - 1
+
+    for keys in (curve.morton_keys, curve.hilbert_keys):
+        key = keys(points, bits)
+        assert (np.sort(key) == np.arange(len(points))).all()
+
+    # consecutive cells along Hilbert curve are always neighbours
+    path = cells[np.argsort(curve.hilbert_keys(points, bits))]
+    assert (np.abs(np.diff(path, axis=0)).sum(axis=1) == 1).all()
+
+    df = given.make_data(5000)
+    a0 = xyz.use_3dtree(df.copy())
+    for order in ('morton', 'hilbert'):
+        check_solution(lambda df: xyz.use_3dtree(df, order=order))
+        check_solution(lambda df: xyz.use_3dtree(df, order=order,
+                                                 compact='float32'))
+        a1 = xyz.use_3dtree(df.copy(), order=order)
+        assert (a1.neighbour_index == a0.neighbour_index).all()
+        assert (a1.distance_km == a0.distance_km).all()
+
+        # a lone point has no neighbour to renumber
+        for compact in (None, 'float32'):
+            a2 = xyz.use_3dtree(df[:1].copy(), compact=compact, order=order)
+            assert (a2.neighbour_index == -1).all()
+
+    try:
+        curve.curve_order(points, 'peano')
+    except ValueError:
+        pass
+    else:
+        assert False, 'unknown curve should be refused'
+
+
+def test_query_service(tmp_path):
+    '''
+    Test that concurrent single-point queries to service are batched,
+    and answered as `xyz.use_reference()` would answer them.
+    '''
+
+    import asyncio
+
+    from opt_nn import service
+
+    df = given.make_data(1000)
+    queries, reference = df[:200], df[200:].reset_index(drop=True)
+    a0 = xyz.use_reference(queries.copy(), reference)
+
+    async def run():
+        index = xyz.ReferenceIndex(reference)
+        query_service = service.QueryService(index, window=0.01)
+        server = await query_service.serve(path=str(tmp_path / 'nn.sock'))
+
+        async with server:
+            client = await service.QueryClient.connect(
+                path=str(tmp_path / 'nn.sock'))
+            answers = await asyncio.gather(*[
+                client.query(lat, lng)
+                for lat, lng in zip(queries.lat, queries.lng)])
+            stats = await client.stats()
+            await client.close()
+
+        await query_service.stop()
+        return answers, stats
+
+    answers, stats = asyncio.run(run())
+    neighbour_index, distance_km = zip(*answers)
+
+    assert list(neighbour_index) == list(a0.neighbour_index)
+    assert np.allclose(distance_km, a0.distance_km, rtol=1e-12)
+    assert stats['queries'] == 200
+    assert stats['batches'] < 200
+    assert 0 < stats['p50_latency'] <= stats['p99_latency']
+
+
+
+def test_query_service_errors(tmp_path):
+    '''
+    Test that service answers a point with no neighbour with strict
+    JSON (null rather than NaN), bad requests with an error, and
+    requests it can't answer once stopped with an error, not silence.
+    '''
+
+    import asyncio
+    import json
+
+    from opt_nn import data, service
+
+    path = str(tmp_path / 'nn.sock')
+
+    async def run():
+        index = xyz.ReferenceIndex(data.generate(0, seed=0))
+        query_service = service.QueryService(index)
+        server = await query_service.serve(path=path)
+
+        async with server:
+            reader, writer = await asyncio.open_unix_connection(path)
+            lines = []
+            for request in (b'{"lat": 1, "lng": 2}', b'{"lat": 1}',
+                            b'[1, 2]', b'{"lat": "north", "lng": 2}',
+                            b'not json'):
+                writer.write(request + b'\n')
+                await writer.drain()
+                lines.append(await reader.readline())
+            writer.close()
+            await writer.wait_closed()
+
+            await query_service.stop()
+            client = await service.QueryClient.connect(path=path)
+            for _ in range(2):
+                try:
+                    await asyncio.wait_for(client.query(1, 2), 5)
+                except RuntimeError:
+                    pass
+                else:
+                    assert False, 'stopped service should answer error'
+            await client.close()
+
+        return lines
+
+    def strict(constant):
+        raise ValueError(f'{constant} is not valid JSON')
+
+    lines = asyncio.run(run())
+    responses = [json.loads(line, parse_constant=strict) for line in lines]
+
+    assert responses[0] == {'neighbour_index': -1, 'distance_km': None}
+    assert all('error' in response for response in responses[1:])
+
+
+def test_query_service_stop():
+    '''
+    Test that stopping service answers batches already being answered,
+    but fails queries still waiting, rather than leaving them hanging.
+    '''
+
+    import asyncio
+    import time
+
+    from opt_nn import service
+
+    reference = given.make_data(100)
+    index = xyz.ReferenceIndex(reference)
+
+    class SlowIndex():
+        def query(self, df):
+            time.sleep(0.2)
+            return index.query(df)
+
+    async def run():
+        query_service = service.QueryService(SlowIndex(), window=0.01,
+                                             max_batch=2, workers=1)
+        await query_service.start()
+
+        lookups = [asyncio.ensure_future(query_service.lookup(lat, lng))
+                   for lat, lng in zip(reference.lat[:6], reference.lng[:6])]
+
+        # let first batch start, and second wait for a thread
+        await asyncio.sleep(0.1)
+        await asyncio.wait_for(query_service.stop(), 5)
+
+        try:
+            await query_service.lookup(0, 0)
+        except RuntimeError:
+            pass
+        else:
+            assert False, 'stopped service should refuse lookups'
+
+        return await asyncio.wait_for(
+            asyncio.gather(*lookups, return_exceptions=True), 5)
+
+    answers = asyncio.run(run())
+
+    assert answers[:2] == [(i, 0.0) for i in range(2)]
+    assert all(isinstance(answer, RuntimeError) for answer in answers[2:])